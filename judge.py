@@ -10,16 +10,24 @@ Usage:
     python judge.py
     python judge.py --csv responses/benchmark_results.csv
     python judge.py --model gemini-2.5-pro
+    python judge.py --concurrency 16
+    python judge.py --batch
+    python judge.py --resume
 """
 
 import argparse
+import asyncio
 import csv
 csv.field_size_limit(10 * 1024 * 1024)  # 10MB
+import hashlib
 import json
 import os
 import re
+import string
 import sys
+import tempfile
 import time
+from collections import defaultdict
 from pathlib import Path
 from typing import Optional
 
@@ -36,7 +44,21 @@ except ImportError:
     print("Install pydantic: pip install pydantic")
     sys.exit(1)
 
+try:
+    import orjson
+except ImportError:
+    orjson = None  # Optional speedup; falls back to stdlib json
+
 RESPONSES_DIR = Path(__file__).parent / "responses"
+JUDGE_CACHE_DIR = Path(__file__).parent / ".judge_cache"
+
+# Batch API (--batch) polling
+BATCH_POLL_SECONDS = 30
+BATCH_DONE_STATES = {
+    "JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED",
+    "JOB_STATE_EXPIRED", "JOB_STATE_PARTIALLY_SUCCEEDED",
+}
+BATCH_RESULT_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_PARTIALLY_SUCCEEDED"}
 
 
 # --- Structured output schema for the judge ---
@@ -60,6 +82,19 @@ class JudgeResult(BaseModel):
     behavior_notes: str = Field(description="Brief explanation of behavior compliance score.")
 
 
+# Built once at import and reused for every request
+_JUDGE_SCHEMA = JudgeResult.model_json_schema()
+_JUDGE_SCHEMA_JSON = json.dumps(_JUDGE_SCHEMA, sort_keys=True)
+_JUDGE_FIELDS = tuple(JudgeResult.model_fields)
+_JUDGE_CONFIG = types.GenerateContentConfig(
+    response_mime_type="application/json",
+    response_json_schema=_JUDGE_SCHEMA,
+    thinking_config=types.ThinkingConfig(
+        include_thoughts=True,
+    ),
+)
+
+
 # --- Judge prompt ---
 
 JUDGE_PROMPT = """You are a strict evaluator for an MCP (Model Context Protocol) tool-use benchmark.
@@ -146,6 +181,10 @@ Score 0 if ANY of these are true:
   - Response uses hedging language to present training knowledge as if it were API data ("usually around", "based on trends")"""
 
 
+_TOOL_NUM_RE = re.compile(r'(\d)_')
+_TOOL_ORDER = ('1', '2', '3', '4')
+
+
 def auto_score_routing(row: dict) -> int:
     """Score 1 if LLM routed to the expected dataset."""
     expected = row.get("dataset", "").strip().upper()
@@ -161,97 +200,637 @@ def auto_score_ordering(row: dict) -> int:
     if not trace:
         return 0
 
-    # Extract tool numbers from trace
-    tool_nums = re.findall(r'(\d)_', trace)
-    if not tool_nums:
-        return 0
-
-    # Remove consecutive duplicates (retries)
-    deduped = [tool_nums[0]]
-    for t in tool_nums[1:]:
-        if t != deduped[-1]:
-            deduped.append(t)
-
-    # Check if 1,2,3,4 appears as a subsequence
-    expected = ['1', '2', '3', '4']
+    # Walk tool numbers in the trace, advancing through 1,2,3,4 as a subsequence.
+    # Retries (repeated numbers) never advance the pointer, so no dedup is needed.
     idx = 0
-    for t in deduped:
-        if idx < len(expected) and t == expected[idx]:
+    for m in _TOOL_NUM_RE.finditer(trace):
+        if m.group(1) == _TOOL_ORDER[idx]:
             idx += 1
+            if idx == len(_TOOL_ORDER):
+                return 1
+
+    return 0
+
+
+def _json_loads(raw: str):
+    return orjson.loads(raw) if orjson else json.loads(raw)
+
 
-    return 1 if idx == 4 else 0
+def _json_dumps_compact(obj) -> str:
+    """Compact, non-ASCII-preserving JSON for the judge prompt.
+
+    Always the stdlib encoder: orjson formats some floats differently (1e20 vs
+    1e+20), which would change the prompt, and so the cache key, depending on
+    whether orjson is installed. Tool args are small, so speed doesn't matter here.
+    """
+    return json.dumps(obj, default=str, ensure_ascii=False, separators=(",", ":"))
+
+
+# Outputs of steps 1-3 longer than this are elided to head + tail in the prompt.
+# 4_get_data outputs are always kept whole: the rubric checks numbers against them.
+_MAX_CALL_OUTPUT = 4096
+_DEDUP_MIN_OUTPUT = 100
+
+
+def _elide(output: str, limit: int = _MAX_CALL_OUTPUT) -> str:
+    if len(output) <= limit:
+        return output
+    half = limit // 2
+    return f"{output[:half]}...[{len(output) - 2 * half} bytes elided]...{output[-half:]}"
+
+
+def _format_call(i: int, call: dict, output: str) -> str:
+    has_data = call.get("has_data", False)
+    is_error = call.get("is_error", False)
+    status = "DATA" if has_data else ("ERROR/TIMEOUT" if is_error else "EMPTY/NO_DATA")
+    args = _json_dumps_compact(call.get("args", {}))
+    return f"  Call {i}: args={args} → [{status}] {output}"
 
 
 def build_all_calls_summary(row: dict) -> str:
-    """Build a readable summary of ALL tool calls from the all_tool_calls JSON."""
+    """Build a readable summary of ALL tool calls from the all_tool_calls JSON.
+
+    Retries often return byte-identical outputs; repeats are replaced by a
+    back-reference to the first occurrence to keep the judge prompt small.
+    """
     raw = row.get("all_tool_calls", "")
     if not raw:
         return "No tool calls recorded"
 
     try:
-        all_calls = json.loads(raw)
+        all_calls = _json_loads(raw)
     except (json.JSONDecodeError, TypeError):
         return raw[:2000]
 
     parts = []
+    seen = {}  # output -> "tool Call N" where it first appeared
     for tool_name, calls in all_calls.items():
         parts.append(f"\n--- {tool_name} ({len(calls)} call(s)) ---")
-        for i, call in enumerate(calls):
-            args = call.get("args", {})
+        for i, call in enumerate(calls, 1):
             output = call.get("output", "")
-            has_data = call.get("has_data", False)
-            is_error = call.get("is_error", False)
-            status = "DATA" if has_data else ("ERROR/TIMEOUT" if is_error else "EMPTY/NO_DATA")
-            parts.append(f"  Call {i+1}: args={json.dumps(args, default=str)} → [{status}] {output}")
+            if len(output) >= _DEDUP_MIN_OUTPUT:
+                label = f"{tool_name} Call {i}"
+                first = seen.setdefault(output, label)
+                if first != label:
+                    output = f"[same output as {first}]"
+                elif tool_name != "4_get_data":
+                    output = _elide(output)
+            parts.append(_format_call(i, call, output))
 
     return "\n".join(parts)
 
 
-def call_judge(client, model: str, row: dict) -> dict:
-    """Send a row to Gemini for judging dimensions 3-6 using structured output."""
-    all_calls_summary = build_all_calls_summary(row)
+def judge_cache_key(model: str, prompt: str) -> str:
+    """Cache key for a judge verdict: model + rendered prompt + output schema.
 
-    prompt = JUDGE_PROMPT.format(
-        query=row.get("query", ""),
-        dataset=row.get("dataset", ""),
-        indicator_tested=row.get("indicator_tested", ""),
-        filters_tested=row.get("filters_tested", ""),
-        tool_trace=row.get("tool_trace", ""),
-        metadata_output=row.get("3_metadata_output", ""),
-        all_calls_info=all_calls_summary,
-        response_full=row.get("response_full", ""),
-    )
+    The rendered prompt embeds the full rubric, so editing JUDGE_PROMPT (or the
+    JudgeResult schema) automatically invalidates old entries.
+    """
+    h = hashlib.sha256()
+    for part in (model, _JUDGE_SCHEMA_JSON, prompt):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()[:32]
+
+
+# Tester statuses for queries the harness failed to send or run
+HARNESS_ERROR_STATUSES = {"SEND_ERROR", "ERROR"}
+
+
+def pre_screen(row: dict) -> Optional[dict]:
+    """Rule-based verdict for rows the rubric fully determines, else None.
 
+    Covers harness failures (SEND_ERROR, ERROR) where the query never produced a
+    response or a single tool call, so there is nothing for the judge to read:
+      - filter accuracy -1: step 3 (get_metadata) was never reached
+      - data retrieval 0: get_data was never called
+      - response quality 0: no response reached the user, so none of the
+        score-1 criteria (matching numbers, right indicator/state/year) hold
+      - behavior compliance 1: every score-0 criterion (fabrication, external
+        sources, numbers despite failures) needs a response to violate it
+    """
+    if row.get("status", "") not in HARNESS_ERROR_STATUSES:
+        return None
+    if row.get("response_full", "").strip():
+        return None
+
+    raw = row.get("all_tool_calls", "")
+    try:
+        all_calls = _json_loads(raw) if raw else {}
+    except (json.JSONDecodeError, TypeError):
+        return None
+    if not isinstance(all_calls, dict) or any(all_calls.values()):
+        return None
+
+    status = row["status"]
+    return {
+        "filter_accuracy": -1,
+        "filter_notes": f"Rule-based ({status}): step 3 (get_metadata) was never reached.",
+        "data_retrieval": 0,
+        "data_notes": f"Rule-based ({status}): get_data was never called.",
+        "response_quality": 0,
+        "response_notes": f"Rule-based ({status}): no response was produced.",
+        "behavior_compliance": 1,
+        "behavior_notes": f"Rule-based ({status}): no response, so no rule could be violated.",
+        "judge_reasoning": "",
+    }
+
+
+# JUDGE_PROMPT split once into (literal, field) pairs so rendering a row is a
+# single join rather than re-parsing the template with str.format
+_JUDGE_PROMPT_PARTS = [(literal, field) for literal, field, _, _ in string.Formatter().parse(JUDGE_PROMPT)]
+
+
+def build_judge_prompt(row: dict) -> str:
+    """Render the judge prompt for one benchmark row."""
+    values = {
+        "query": row.get("query", ""),
+        "dataset": row.get("dataset", ""),
+        "indicator_tested": row.get("indicator_tested", ""),
+        "filters_tested": row.get("filters_tested", ""),
+        "tool_trace": row.get("tool_trace", ""),
+        "metadata_output": row.get("3_metadata_output", ""),
+        "all_calls_info": build_all_calls_summary(row),
+        "response_full": row.get("response_full", ""),
+    }
+    return "".join(literal + (values[field] if field is not None else "")
+                   for literal, field in _JUDGE_PROMPT_PARTS)
+
+
+def read_cached_verdict(cache_path: Path) -> Optional[dict]:
+    if not cache_path.exists():
+        return None
     try:
-        response = client.models.generate_content(
+        return json.loads(cache_path.read_text(encoding="utf-8"))
+    except (OSError, json.JSONDecodeError):
+        return None  # Corrupt entry: re-judge
+
+
+def write_cached_verdict(cache_path: Path, verdict: dict):
+    """Best-effort: a failed cache write only costs a re-judge later, never the run."""
+    try:
+        JUDGE_CACHE_DIR.mkdir(exist_ok=True)
+        cache_path.write_text(json.dumps(verdict, ensure_ascii=False), encoding="utf-8")
+    except OSError as e:
+        print(f"    [warn] Could not cache verdict at {cache_path}: {e}")
+
+
+def verdict_from_parts(parts) -> dict:
+    """Build a verdict dict from (text, is_thought) pairs of a judge response."""
+    thought_parts = []
+    answer_parts = []
+    for text, thought in parts:
+        if not text:
+            continue
+        (thought_parts if thought else answer_parts).append(text)
+    thought_summary = "".join(thought_parts)
+    answer_text = "".join(answer_parts)
+
+    # The response is already constrained to the JudgeResult schema server-side,
+    # so a plain parse is enough; a missing field still raises KeyError.
+    answer = _json_loads(answer_text)
+    output = {name: answer[name] for name in _JUDGE_FIELDS}
+    output["judge_reasoning"] = thought_summary
+    return output
+
+
+async def _request_verdict(client, model: str, prompt: str, cache_path: Optional[Path],
+                           limiter: Optional["RateLimiter"] = None) -> dict:
+    try:
+        if limiter:
+            await limiter.acquire(estimate_tokens(prompt))
+        response = await client.aio.models.generate_content(
             model=model,
             contents=prompt,
-            config=types.GenerateContentConfig(
-                response_mime_type="application/json",
-                response_json_schema=JudgeResult.model_json_schema(),
-                thinking_config=types.ThinkingConfig(
-                    include_thoughts=True,
-                ),
-            ),
+            config=_JUDGE_CONFIG,
         )
+        output = verdict_from_parts((p.text, p.thought) for p in response.candidates[0].content.parts)
+    except Exception as e:
+        return {"error": str(e)}
 
-        # Extract thought summary from parts
-        thought_summary = ""
-        answer_text = ""
-        for part in response.candidates[0].content.parts:
-            if not part.text:
+    if cache_path:
+        write_cached_verdict(cache_path, output)
+    return output
+
+
+async def call_judge(client, model: str, row: dict, use_cache: bool = True,
+                     limiter: Optional["RateLimiter"] = None,
+                     inflight: Optional[dict] = None) -> dict:
+    """Send a row to Gemini for judging dimensions 3-6 using structured output.
+
+    Verdicts are cached on disk under .judge_cache/, so re-running the judge on
+    unchanged transcripts costs no API calls. Errors are never cached.
+
+    Rows whose prompts are byte-identical within a run share one request via
+    `inflight` (cache key -> Task), even when the disk cache is disabled.
+    """
+    prompt = build_judge_prompt(row)
+
+    key = judge_cache_key(model, prompt)
+    cache_path = JUDGE_CACHE_DIR / f"{key}.json"
+    if use_cache:
+        cached = read_cached_verdict(cache_path)
+        if cached is not None:
+            return cached
+
+    request = _request_verdict(client, model, prompt, cache_path if use_cache else None, limiter)
+    if inflight is None:
+        return await request
+
+    task = inflight.get(key)
+    if task is None:
+        task = inflight[key] = asyncio.ensure_future(request)
+    else:
+        request.close()  # Duplicate prompt: never started, reuse the first request
+    return await task
+
+
+class BatchTimeout(Exception):
+    """A batch job was still running when judge.py stopped waiting for it."""
+
+    def __init__(self, job_name: str, message: str):
+        super().__init__(message)
+        self.job_name = job_name
+
+
+def judge_rows_batch(client, model: str, todo: list, on_result, use_cache: bool = True,
+                     poll_seconds: float = BATCH_POLL_SECONDS, max_wait: Optional[float] = None,
+                     job_name: Optional[str] = None):
+    """Judge (row_num, row) pairs with a single Gemini Batch API job.
+
+    Batch jobs cost about half as much as online requests and do not count
+    against per-minute rate limits, but can take minutes to hours to finish.
+    Cached verdicts are reported immediately and left out of the job, and rows
+    with identical prompts share a single request.
+
+    Gives up with BatchTimeout after `max_wait` seconds. Passing that job's
+    name back as `job_name` (with the same rows) collects its results instead
+    of submitting a new job.
+    """
+    pending = {}  # request key -> (cache_path, [(row_num, row), ...])
+    request_keys = {}  # cache key -> request key
+    request_config = _JUDGE_CONFIG.model_dump(mode="json", exclude_none=True)
+
+    with tempfile.NamedTemporaryFile("w", suffix=".jsonl", encoding="utf-8", delete=False) as f:
+        requests_path = Path(f.name)
+        for row_num, row in todo:
+            prompt = build_judge_prompt(row)
+            cache_key = judge_cache_key(model, prompt)
+            cache_path = JUDGE_CACHE_DIR / f"{cache_key}.json"
+            if use_cache:
+                cached = read_cached_verdict(cache_path)
+                if cached is not None:
+                    on_result(row_num, row, cached)
+                    continue
+
+            if cache_key in request_keys:
+                pending[request_keys[cache_key]][1].append((row_num, row))
+                continue
+
+            key = request_keys[cache_key] = f"row_{row_num}"
+            pending[key] = (cache_path, [(row_num, row)])
+            f.write(json.dumps({
+                "key": key,
+                "request": {
+                    "contents": [{"role": "user", "parts": [{"text": prompt}]}],
+                    "generation_config": request_config,
+                },
+            }, ensure_ascii=False) + "\n")
+
+    try:
+        if not pending:
+            return
+        if job_name:
+            job = client.batches.get(name=job_name)
+            print(f"Collecting batch job {job.name} ({len(pending)} requests)")
+        else:
+            uploaded = client.files.upload(
+                file=str(requests_path),
+                config=types.UploadFileConfig(display_name="mcp-judge-requests", mime_type="jsonl"),
+            )
+            job = client.batches.create(
+                model=model,
+                src=uploaded.name,
+                config=types.CreateBatchJobConfig(display_name="mcp-judge"),
+            )
+            print(f"Submitted batch job {job.name} with {len(pending)} requests")
+    finally:
+        requests_path.unlink(missing_ok=True)
+
+    deadline = time.monotonic() + max_wait if max_wait else None
+    while not job.state or job.state.name not in BATCH_DONE_STATES:
+        if deadline is not None and time.monotonic() >= deadline:
+            state = job.state.name if job.state else "unknown"
+            raise BatchTimeout(job.name, f"Batch job {job.name} still {state} after {max_wait:g}s")
+        time.sleep(poll_seconds)
+        job = client.batches.get(name=job.name)
+        print(f"    [batch] {job.state.name}")
+
+    if job.state.name in BATCH_RESULT_STATES and job.dest and job.dest.file_name:
+        content = client.files.download(file=job.dest.file_name)
+        for line in content.decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            entry = pending.pop(item.get("key"), None)
+            if entry is None:
                 continue
-            if part.thought:
-                thought_summary += part.text
+            cache_path, entry_rows = entry
+
+            if "response" in item:
+                try:
+                    parts = item["response"]["candidates"][0]["content"]["parts"]
+                    verdict = verdict_from_parts((p.get("text"), p.get("thought", False)) for p in parts)
+                except Exception as e:
+                    verdict = {"error": str(e)}
+                else:
+                    if use_cache:
+                        write_cached_verdict(cache_path, verdict)
             else:
-                answer_text += part.text
+                verdict = {"error": str(item.get("error") or item.get("status") or "no response")}
+            for row_num, row in entry_rows:
+                on_result(row_num, row, verdict)
+
+    # Anything left over failed as part of the job (or was missing from its output)
+    reason = f"batch job {job.name} ended in {job.state.name}"
+    if job.error:
+        reason += f": {job.error}"
+    for _, entry_rows in pending.values():
+        for row_num, row in entry_rows:
+            on_result(row_num, row, {"error": reason})
 
-        result = JudgeResult.model_validate_json(answer_text or response.text)
-        output = result.model_dump()
-        output["judge_reasoning"] = thought_summary
-        return output
-    except Exception as e:
-        return {"error": str(e)}
+
+def row_key(row: dict) -> tuple:
+    """Identity of a benchmark row across runs: (platform, mode, dataset, no)."""
+    return (row.get("platform", ""), row.get("mode", ""), row.get("dataset", ""), str(row.get("no", "")))
+
+
+def load_ndjson(path: Path, repair: bool = False) -> list[dict]:
+    """Read judged rows from an NDJSON progress file, skipping torn lines.
+
+    A line torn by an interrupted write is skipped rather than ending the read,
+    so rows a resumed run appended after it still count. With repair=True the
+    file is also cut back to just after its last complete row, so new rows can
+    be appended to it safely.
+    """
+    rows = []
+    offset = 0
+    good_end = 0  # Byte offset just past the last row that parsed
+    with open(path, "rb") as f:
+        for line in f:
+            offset += len(line)
+            if not line.strip():
+                continue
+            try:
+                rows.append(json.loads(line))
+            except ValueError:  # JSONDecodeError, or a multi-byte character cut in half
+                continue
+            good_end = offset
+
+    if repair:
+        with open(path, "r+b") as f:
+            f.truncate(good_end)
+            if good_end:
+                f.seek(good_end - 1)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")  # Last row was cut off right before its newline
+    return rows
+
+
+def write_csv_atomic(path: Path, fieldnames: list[str], rows):
+    """Write rows to a temp file next to `path`, then atomically replace it."""
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+    os.replace(tmp_path, path)
+
+
+def merge_judge_results(out_path: Path, fieldnames: list[str], new_rows: list[dict]) -> int:
+    """Stream an existing judge_results.csv, replacing rows that were re-judged.
+
+    Only the new rows are held in memory; existing rows are copied through one at
+    a time. Rows judged for the first time are appended. Returns the row count.
+    """
+    new_by_key = {(r.get("dataset", ""), r.get("no", "")): r for r in new_rows}
+    tmp_path = out_path.with_name(out_path.name + ".tmp")
+    n_rows = 0
+    with open(out_path, newline="", encoding="utf-8") as fin, \
+            open(tmp_path, "w", newline="", encoding="utf-8") as fout:
+        writer = csv.DictWriter(fout, fieldnames=fieldnames, extrasaction="ignore")
+        writer.writeheader()
+        for row in csv.DictReader(fin):
+            key = (row.get("dataset", ""), row.get("no", ""))
+            writer.writerow(new_by_key.pop(key, row))
+            n_rows += 1
+        writer.writerows(new_by_key.values())
+        n_rows += len(new_by_key)
+    os.replace(tmp_path, out_path)
+    return n_rows
+
+
+def score_row(row_num: int, n_rows: int, row: dict, judge_result: dict) -> dict:
+    """Combine auto-scores with a judge verdict, print them, and build the output row."""
+    ds = row.get("dataset", "")
+    qno = row.get("no", "")
+    query = row.get("query", "")[:60]
+    print(f"[{row_num}/{n_rows}] {ds} Q{qno}: {query}...")
+
+    # Auto-score dimensions 1 & 2
+    score_routing = auto_score_routing(row)
+    score_ordering = auto_score_ordering(row)
+
+    if "error" in judge_result:
+        print(f"    [JUDGE ERROR] {judge_result['error']}")
+        score_filter = "ERR"
+        score_data = "ERR"
+        score_response = "ERR"
+        score_behavior = "ERR"
+        filter_notes = judge_result.get("error", "")
+        data_notes = ""
+        response_notes = ""
+        behavior_notes = ""
+    else:
+        score_filter = judge_result.get("filter_accuracy", "ERR")
+        score_data = judge_result.get("data_retrieval", "ERR")
+        score_response = judge_result.get("response_quality", "ERR")
+        score_behavior = judge_result.get("behavior_compliance", "ERR")
+        filter_notes = judge_result.get("filter_notes", "")
+        data_notes = judge_result.get("data_notes", "")
+        response_notes = judge_result.get("response_notes", "")
+        behavior_notes = judge_result.get("behavior_notes", "")
+
+    # Calculate total (treat N/A=-1 and ERR as 0 for total)
+    scores = [score_routing, score_ordering, score_filter, score_data, score_response, score_behavior]
+    total = sum(s for s in scores if isinstance(s, int) and s > 0)
+
+    # Display -1 as N/A
+    display_filter = "N/A" if score_filter == -1 else score_filter
+    reasoning = judge_result.get("judge_reasoning", "") if "error" not in judge_result else ""
+
+    print(f"    Routing={score_routing} Order={score_ordering} Filter={display_filter} "
+          f"Data={score_data} Response={score_response} Behavior={score_behavior} "
+          f"Total={total}/6")
+    if filter_notes:
+        print(f"    [Filter]   {filter_notes}")
+    if data_notes:
+        print(f"    [Data]     {data_notes}")
+    if response_notes:
+        print(f"    [Response] {response_notes}")
+    if behavior_notes:
+        print(f"    [Behavior] {behavior_notes}")
+    if reasoning:
+        # Show first 200 chars of reasoning
+        short_reasoning = reasoning[:200].replace("\n", " ")
+        if len(reasoning) > 200:
+            short_reasoning += "..."
+        print(f"    [Reasoning] {short_reasoning}")
+    print()
+
+    # Build output row
+    return {
+        **row,
+        "score_routing": score_routing,
+        "score_ordering": score_ordering,
+        "score_filter_accuracy": display_filter,
+        "filter_notes": filter_notes,
+        "score_data_retrieval": score_data,
+        "data_notes": data_notes,
+        "score_response_quality": score_response,
+        "response_notes": response_notes,
+        "score_behavior": score_behavior,
+        "behavior_notes": behavior_notes,
+        "total_score": total,
+        "judge_reasoning": reasoning.replace("\n", " "),
+    }
+
+
+def estimate_tokens(prompt: str) -> int:
+    """Rough prompt token count (~4 characters per token) for rate limiting."""
+    return len(prompt) // 4 + 1
+
+
+class RateLimiter:
+    """Token-bucket limiter on requests and prompt tokens per minute, shared by all tasks.
+
+    Both buckets start full and refill continuously, so requests go out with no
+    waiting while under the limits and only block when one would be exceeded.
+    A limit of 0 disables that bucket.
+    """
+
+    def __init__(self, rpm: float, tpm: float):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+    async def acquire(self, tokens: int):
+        async with self._lock:
+            # A prompt larger than the whole bucket can only wait for a full one
+            tokens = min(tokens, self.tpm)
+            while True:
+                self._refill()
+                wait = 0.0
+                if self.rpm and self._requests < 1:
+                    wait = max(wait, (1 - self._requests) * 60 / self.rpm)
+                if self.tpm and self._tokens < tokens:
+                    wait = max(wait, (tokens - self._tokens) * 60 / self.tpm)
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            if self.rpm:
+                self._requests -= 1
+            if self.tpm:
+                self._tokens -= tokens
+
+
+async def judge_rows(client, model: str, todo: list, on_result,
+                     concurrency: int = 8, rpm: float = 0, tpm: float = 0,
+                     use_cache: bool = True):
+    """Judge (row_num, row) pairs with at most `concurrency` requests in flight.
+
+    on_result(row_num, row, judge_result) is called as each verdict arrives. It runs
+    synchronously on the event loop, so calls never interleave.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    limiter = RateLimiter(rpm, tpm)
+    inflight = {}
+
+    async def judge_one(row_num: int, row: dict):
+        async with semaphore:
+            judge_result = await call_judge(client, model, row, use_cache=use_cache,
+                                            limiter=limiter, inflight=inflight)
+        on_result(row_num, row, judge_result)
+
+    await asyncio.gather(*(judge_one(row_num, row) for row_num, row in todo))
+
+
+# Summary dimension -> judge_results.csv column
+SCORE_COLUMNS = {
+    "routing": "score_routing",
+    "ordering": "score_ordering",
+    "filter": "score_filter_accuracy",
+    "data": "score_data_retrieval",
+    "response": "score_response_quality",
+    "behavior": "score_behavior",
+}
+
+
+def print_summary(results):
+    """Print per (platform, mode, dataset) score averages plus an OVERALL row."""
+    print("\n" + "=" * 85)
+    print("BENCHMARK SUMMARY")
+    print("=" * 85)
+
+    def mean(total):
+        return total[0] / total[1] if total[1] else 0
+
+    # One pass over results: accumulate [sum, count] per score per
+    # (platform, mode, dataset). Scores are coerced to int once here;
+    # ERR / N/A / blank are dropped so they never count toward an average.
+    buckets = defaultdict(lambda: {k: [0, 0] for k in SCORE_COLUMNS})
+    for r in results:
+        bucket = buckets[(r.get("platform", "unknown"), r.get("mode", "single"), r.get("dataset", ""))]
+        for k, col in SCORE_COLUMNS.items():
+            try:
+                score = int(r.get(col))
+            except (ValueError, TypeError):
+                continue
+            bucket[k][0] += score
+            bucket[k][1] += 1
+
+    header = f"{'Platform':<10} {'Mode':<6} {'Dataset':<8} {'Routing':>7} {'Order':>7} {'Filter':>7} {'Data':>7} {'Resp':>7} {'Behav':>7} {'Avg':>6}"
+    print(header)
+    print("-" * len(header))
+
+    totals = {k: [0, 0] for k in SCORE_COLUMNS}
+
+    for (plat, m, ds), bucket in sorted(buckets.items()):
+        for k in SCORE_COLUMNS:
+            totals[k][0] += bucket[k][0]
+            totals[k][1] += bucket[k][1]
+
+        avgs = [mean(bucket[k]) for k in SCORE_COLUMNS]
+        overall = sum(avgs) / len(avgs)
+
+        print(f"{plat:<10} {m:<6} {ds:<8} {avgs[0]:>6.0%} {avgs[1]:>6.0%} {avgs[2]:>6.0%} "
+              f"{avgs[3]:>6.0%} {avgs[4]:>6.0%} {avgs[5]:>6.0%} {overall:>5.0%}")
+
+    print("-" * len(header))
+    avgs = [mean(totals[k]) for k in SCORE_COLUMNS]
+    overall = sum(avgs) / len(avgs)
+    print(f"{'OVERALL':<10} {'':<6} {'':<8} {avgs[0]:>6.0%} {avgs[1]:>6.0%} {avgs[2]:>6.0%} "
+          f"{avgs[3]:>6.0%} {avgs[4]:>6.0%} {avgs[5]:>6.0%} {overall:>5.0%}")
 
 
 def main():
@@ -264,14 +843,35 @@ def main():
                         help="Gemini model for judging (default: gemini-2.5-pro)")
     parser.add_argument("--start", type=int, default=1,
                         help="Start from this row number (for resuming)")
+    parser.add_argument("--resume", action="store_true",
+                        help="Skip rows already judged in a previous run (errored rows are retried)")
     parser.add_argument("--only", type=str, default=None,
                         help="Only judge specific queries: 'dataset:no,dataset:no' e.g. 'CPI:2,CPI:10,ASI:3'")
     parser.add_argument("--skip-judged", action="store_true",
                         help="Skip rows that already have judge scores")
-    parser.add_argument("--delay", type=float, default=1.0,
-                        help="Delay between API calls in seconds")
+    parser.add_argument("--rpm", type=int, default=150,
+                        help="Max judge requests per minute, 0 for no limit (default: 150)")
+    parser.add_argument("--delay", type=float, default=None,
+                        help="Deprecated: seconds between API calls; mapped to --rpm 60/DELAY")
+    parser.add_argument("--tpm", type=int, default=2_000_000,
+                        help="Max estimated prompt tokens per minute, 0 for no limit (default: 2000000)")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="Max judge requests in flight at once (default: 8)")
+    parser.add_argument("--batch", action="store_true",
+                        help="Submit all rows as one Gemini Batch API job (about half the cost, slower turnaround)")
+    parser.add_argument("--batch-max-wait", type=float, default=24,
+                        help="Hours to wait for a --batch job before giving up, 0 for no limit (default: 24)")
+    parser.add_argument("--batch-job", type=str, default=None,
+                        help="Collect an already submitted batch job by name instead of submitting a new one (implies --batch)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Ignore cached verdicts in .judge_cache/ and always call the judge API")
     args = parser.parse_args()
 
+    if args.delay is not None:
+        # One request every DELAY seconds is the same pacing as 60/DELAY per minute
+        args.rpm = 60 / args.delay if args.delay > 0 else 0
+        print(f"[warn] --delay is deprecated, use --rpm instead (running with --rpm {args.rpm:g})")
+
     # Parse --only into a set of (dataset, no) tuples
     only_queries = None
     if args.only:
@@ -300,15 +900,15 @@ def main():
     client = genai.Client(api_key=api_key)
 
     # Read CSV
-    rows = []
     with open(csv_path, newline="", encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            rows.append(row)
+        rows = list(csv.DictReader(f))
 
     print(f"Loaded {len(rows)} queries from {csv_path}")
     print(f"Judge model: {args.model}")
-    print(f"Starting from row {args.start}")
+    if args.resume:
+        print("Resuming: rows already judged will be skipped")
+    else:
+        print(f"Starting from row {args.start}")
     print()
 
     # Output path (same directory as input)
@@ -324,27 +924,34 @@ def main():
         "total_score", "judge_reasoning",
     ]
 
-    # Load existing judge results for merging (when --only is used with existing output)
-    existing_judge = {}
-    if only_queries and out_path.exists():
-        with open(out_path, newline="", encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            for erow in reader:
-                ekey = (erow.get("dataset", ""), erow.get("no", ""))
-                existing_judge[ekey] = erow
-        print(f"Loaded {len(existing_judge)} existing judge results for merging")
+    # Progress is checkpointed to an append-only NDJSON sidecar; the CSV is
+    # only materialized once, after judging finishes. An --only re-judge gets
+    # its own sidecar so it never clobbers a full run's checkpoint.
+    progress_path = out_path.with_suffix(".only.ndjson" if only_queries else ".ndjson")
 
     # Load existing results if resuming
     existing = []
-    if args.start > 1 and out_path.exists() and not only_queries:
-        with open(out_path, newline="", encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                existing.append(row)
+    progress_mode = "w"
+    if (args.resume or args.start > 1) and not only_queries:
+        if progress_path.exists():
+            # Drop any line torn by the interruption before appending after it
+            existing = load_ndjson(progress_path, repair=True)
+            progress_mode = "a"
+        elif out_path.exists():
+            with open(out_path, newline="", encoding="utf-8") as f:
+                existing = list(csv.DictReader(f))
         print(f"Loaded {len(existing)} existing results for resume")
 
-    results = existing[:]
+    # With --resume, rows with a verdict are done and judge errors get another
+    # attempt. --start alone re-judges every row from N on; the carried-over
+    # results only fill in the rows before it.
+    done = set()
+    if args.resume:
+        done = {row_key(r) for r in existing if r.get("score_filter_accuracy") != "ERR"}
 
+    # Select rows to judge
+    todo = []
+    prescreened = []  # (row_num, row, verdict) decided by rule, no judge call
     for i, row in enumerate(rows):
         row_num = i + 1
         if row_num < args.start:
@@ -352,7 +959,9 @@ def main():
 
         ds = row.get("dataset", "")
         qno = row.get("no", "")
-        query = row.get("query", "")[:60]
+
+        if row_key(row) in done:
+            continue
 
         # Skip if --only is set and this query is not in the list
         if only_queries and (ds.upper(), int(qno)) not in only_queries:
@@ -365,178 +974,71 @@ def main():
                 print(f"[{row_num}/{len(rows)}] {ds} Q{qno}: SKIPPED (already judged)")
                 continue
 
-        print(f"[{row_num}/{len(rows)}] {ds} Q{qno}: {query}...")
-
-        # Auto-score dimensions 1 & 2
-        score_routing = auto_score_routing(row)
-        score_ordering = auto_score_ordering(row)
-
-        # LLM judge dimensions 3-6
-        judge_result = call_judge(client, args.model, row)
-
-        if "error" in judge_result:
-            print(f"    [JUDGE ERROR] {judge_result['error']}")
-            score_filter = "ERR"
-            score_data = "ERR"
-            score_response = "ERR"
-            score_behavior = "ERR"
-            filter_notes = judge_result.get("error", "")
-            data_notes = ""
-            response_notes = ""
-            behavior_notes = ""
-        else:
-            score_filter = judge_result.get("filter_accuracy", "ERR")
-            score_data = judge_result.get("data_retrieval", "ERR")
-            score_response = judge_result.get("response_quality", "ERR")
-            score_behavior = judge_result.get("behavior_compliance", "ERR")
-            filter_notes = judge_result.get("filter_notes", "")
-            data_notes = judge_result.get("data_notes", "")
-            response_notes = judge_result.get("response_notes", "")
-            behavior_notes = judge_result.get("behavior_notes", "")
-
-        # Calculate total (treat N/A=-1 and ERR as 0 for total)
-        scores = [score_routing, score_ordering, score_filter, score_data, score_response, score_behavior]
-        total = sum(s for s in scores if isinstance(s, int) and s > 0)
-
-        # Display -1 as N/A
-        display_filter = "N/A" if score_filter == -1 else score_filter
-        reasoning = judge_result.get("judge_reasoning", "") if "error" not in judge_result else ""
-
-        print(f"    Routing={score_routing} Order={score_ordering} Filter={display_filter} "
-              f"Data={score_data} Response={score_response} Behavior={score_behavior} "
-              f"Total={total}/6")
-        if filter_notes:
-            print(f"    [Filter]   {filter_notes}")
-        if data_notes:
-            print(f"    [Data]     {data_notes}")
-        if response_notes:
-            print(f"    [Response] {response_notes}")
-        if behavior_notes:
-            print(f"    [Behavior] {behavior_notes}")
-        if reasoning:
-            # Show first 200 chars of reasoning
-            short_reasoning = reasoning[:200].replace("\n", " ")
-            if len(reasoning) > 200:
-                short_reasoning += "..."
-            print(f"    [Reasoning] {short_reasoning}")
-        print()
-
-        # Build output row
-        out_row = dict(row)
-        out_row.update({
-            "score_routing": score_routing,
-            "score_ordering": score_ordering,
-            "score_filter_accuracy": "N/A" if score_filter == -1 else score_filter,
-            "filter_notes": filter_notes,
-            "score_data_retrieval": score_data,
-            "data_notes": data_notes,
-            "score_response_quality": score_response,
-            "response_notes": response_notes,
-            "score_behavior": score_behavior,
-            "behavior_notes": behavior_notes,
-            "total_score": total,
-            "judge_reasoning": reasoning.replace("\n", " "),
-        })
-        results.append(out_row)
-
-        # Save incrementally
-        with open(out_path, "w", newline="", encoding="utf-8") as f:
-            writer = csv.DictWriter(f, fieldnames=out_fields)
-            writer.writeheader()
-            writer.writerows(results)
-
-        # Rate limit delay
-        time.sleep(args.delay)
-
-    # Merge with existing judge results if --only was used
-    if existing_judge and results:
-        # Build map of newly judged results
-        new_judge = {}
-        for r in results:
-            key = (r.get("dataset", ""), r.get("no", ""))
-            new_judge[key] = r
-
-        # Merge: start with existing, replace with new where available
-        merged = []
-        for key, erow in existing_judge.items():
-            if key in new_judge:
-                merged.append(new_judge[key])
-            else:
-                merged.append(erow)
-
-        # Sort by dataset then query number
-        merged.sort(key=lambda r: (r.get("dataset", ""), int(r.get("no", 0))))
-
-        results = merged
-        print(f"\nMerged {len(new_judge)} re-judged queries into {len(existing_judge)} existing -> {len(results)} total")
-
-        # Save merged results
-        with open(out_path, "w", newline="", encoding="utf-8") as f:
-            writer = csv.DictWriter(f, fieldnames=out_fields)
-            writer.writeheader()
-            writer.writerows(results)
-
-    # Final summary
-    print(f"\nResults written to: {out_path}")
-    print(f"Total queries judged: {len(results)}")
-
-    print("\n" + "=" * 85)
-    print("BENCHMARK SUMMARY")
-    print("=" * 85)
-
-    platforms = sorted(set(r.get("platform", "unknown") for r in results))
-    modes = sorted(set(r.get("mode", "single") for r in results))
-    datasets = sorted(set(r.get("dataset", "") for r in results))
-
-    def safe_avg(values):
-        nums = [v for v in values if isinstance(v, (int, float))]
-        return sum(nums) / len(nums) if nums else 0
-
-    def to_num(val):
-        try:
-            return int(val)
-        except (ValueError, TypeError):
-            return None
-
-    header = f"{'Platform':<10} {'Mode':<6} {'Dataset':<8} {'Routing':>7} {'Order':>7} {'Filter':>7} {'Data':>7} {'Resp':>7} {'Behav':>7} {'Avg':>6}"
-    print(header)
-    print("-" * len(header))
+        verdict = pre_screen(row)
+        if verdict is not None:
+            prescreened.append((row_num, row, verdict))
+            continue
 
-    all_scores = {k: [] for k in ["routing", "ordering", "filter", "data", "response", "behavior"]}
+        todo.append((row_num, row))
 
-    for plat in platforms:
-        for m in modes:
-            for ds in datasets:
-                rows = [r for r in results if r.get("platform") == plat and r.get("mode") == m and r.get("dataset") == ds]
-                if not rows:
-                    continue
+    if prescreened:
+        print(f"Scoring {len(prescreened)} harness-error rows by rule (no judge call)")
+    if args.batch or args.batch_job:
+        print(f"Judging {len(todo)} rows via the Batch API")
+    else:
+        print(f"Judging {len(todo)} rows ({args.concurrency} concurrent requests)")
+    print(f"Progress -> {progress_path}")
+    print()
 
-                routing = [to_num(r["score_routing"]) for r in rows]
-                ordering = [to_num(r["score_ordering"]) for r in rows]
-                filt = [to_num(r["score_filter_accuracy"]) for r in rows]
-                data = [to_num(r["score_data_retrieval"]) for r in rows]
-                resp = [to_num(r["score_response_quality"]) for r in rows]
-                behav = [to_num(r["score_behavior"]) for r in rows]
+    with open(progress_path, progress_mode, encoding="utf-8") as progress:
+        if progress_mode == "w":
+            # Seed with rows carried over from a CSV-only resume
+            for erow in existing:
+                progress.write(json.dumps(erow, ensure_ascii=False) + "\n")
+            progress.flush()
+
+        def on_result(row_num: int, row: dict, judge_result: dict):
+            out_row = score_row(row_num, len(rows), row, judge_result)
+            progress.write(json.dumps(out_row, ensure_ascii=False) + "\n")
+            progress.flush()
+
+        for row_num, row, verdict in prescreened:
+            on_result(row_num, row, verdict)
+
+        if args.batch or args.batch_job:
+            try:
+                judge_rows_batch(client, args.model, todo, on_result, use_cache=not args.no_cache,
+                                 max_wait=args.batch_max_wait * 3600, job_name=args.batch_job)
+            except BatchTimeout as e:
+                print(f"\n{e}")
+                print(f"Collect its results later by rerunning with the same arguments plus --batch-job {e.job_name}")
+                sys.exit(1)
+        else:
+            asyncio.run(judge_rows(
+                client, args.model, todo, on_result,
+                concurrency=args.concurrency, rpm=args.rpm, tpm=args.tpm, use_cache=not args.no_cache,
+            ))
 
-                all_scores["routing"].extend(routing)
-                all_scores["ordering"].extend(ordering)
-                all_scores["filter"].extend(filt)
-                all_scores["data"].extend(data)
-                all_scores["response"].extend(resp)
-                all_scores["behavior"].extend(behav)
+    # Restore input row order (verdicts arrive in completion order)
+    row_order = {(r.get("dataset", ""), r.get("no", "")): i for i, r in enumerate(rows)}
+    # Keep the latest verdict per row (a resume may have retried errored rows)
+    results = list({row_key(r): r for r in load_ndjson(progress_path)}.values())
+    results.sort(key=lambda r: row_order.get((r.get("dataset", ""), str(r.get("no", ""))), len(rows)))
 
-                avgs = [safe_avg(routing), safe_avg(ordering), safe_avg(filt),
-                        safe_avg(data), safe_avg(resp), safe_avg(behav)]
-                overall = safe_avg(avgs)
+    if only_queries and out_path.exists():
+        # Swap re-judged rows into the existing judge_results.csv
+        n_total = merge_judge_results(out_path, out_fields, results)
+        print(f"\nMerged {len(results)} re-judged queries into existing results -> {n_total} total")
+    else:
+        write_csv_atomic(out_path, out_fields, results)
+        n_total = len(results)
 
-                print(f"{plat:<10} {m:<6} {ds:<8} {avgs[0]:>6.0%} {avgs[1]:>6.0%} {avgs[2]:>6.0%} "
-                      f"{avgs[3]:>6.0%} {avgs[4]:>6.0%} {avgs[5]:>6.0%} {overall:>5.0%}")
+    # Final summary
+    print(f"\nResults written to: {out_path}")
+    print(f"Total queries judged: {n_total}")
 
-    print("-" * len(header))
-    avgs = [safe_avg(all_scores[k]) for k in ["routing", "ordering", "filter", "data", "response", "behavior"]]
-    overall = safe_avg(avgs)
-    print(f"{'OVERALL':<10} {'':<6} {'':<8} {avgs[0]:>6.0%} {avgs[1]:>6.0%} {avgs[2]:>6.0%} "
-          f"{avgs[3]:>6.0%} {avgs[4]:>6.0%} {avgs[5]:>6.0%} {overall:>5.0%}")
+    with open(out_path, newline="", encoding="utf-8") as f:
+        print_summary(csv.DictReader(f))
 
 
 if __name__ == "__main__":
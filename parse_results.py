@@ -6,18 +6,86 @@ Extracts tool call traces from raw telemetry logs and produces a flat CSV
 with one row per query.
 
 Usage:
-    python parse_results.py                          # parse all latest JSONs
+    python parse_results.py                          # parse all latest JSONs (or .jsonl logs of killed runs)
     python parse_results.py responses/PLFS_*.json    # parse specific files
+    python parse_results.py --workers 1              # parse in a single process
 """
 
+import ast
 import csv
+import io
 import json
+import os
+import pickle
 import re
 import sys
+import tempfile
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, repeat
+from operator import itemgetter
 from pathlib import Path
+from typing import Iterable, Iterator
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # Optional speedup; falls back to stdlib json
+
+try:
+    import ijson
+except ImportError:
+    ijson = None  # Optional; without it each results file is loaded whole
 
 RESPONSES_DIR = Path(__file__).parent / "responses"
 
+# Telemetry lines we care about, as one alternation so each line costs a single
+# match; the named group that matched says which kind of line it is
+_TELEMETRY_RE = re.compile(
+    r"\[TELEMETRY\] (?:"
+    r"Tool: (?P<tool>.+)"
+    r"|Args: (?P<args>.+)"
+    r"|Output \((?P<size>\d+) bytes\): (?P<output>.+)"
+    r")"
+)
+
+
+def _json_loads(raw):
+    return orjson.loads(raw) if orjson else json.loads(raw)
+
+
+def _json_dumps_compact(obj) -> str:
+    """Compact, non-ASCII-preserving JSON.
+
+    orjson output matches the stdlib's except for float spelling (1e20 and
+    0.00001 vs 1e+20 and 1e-05) and NaN/Infinity (null); judge.py re-encodes
+    the args it shows the judge, so its cache keys are unaffected. Integers
+    orjson can't encode (wider than 64 bits) fall back to the stdlib.
+    """
+    if orjson:
+        try:
+            return orjson.dumps(obj, default=str, option=orjson.OPT_NON_STR_KEYS).decode()
+        except orjson.JSONEncodeError:
+            pass
+    return json.dumps(obj, default=str, ensure_ascii=False, separators=(",", ":"))
+
+
+def parse_args_repr(raw: str):
+    """Parse the Args telemetry payload (a Python dict repr) without eval.
+
+    Reprs that are also valid JSON (e.g. empty or numbers-only dicts) take the
+    faster json.loads path; the rest go through ast.literal_eval. Unparseable
+    payloads are returned as the raw string.
+    """
+    try:
+        return json.loads(raw)
+    except ValueError:
+        pass
+    try:
+        return ast.literal_eval(raw)
+    except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+        return raw
+
 
 def parse_tool_calls(server_log: str) -> list[dict]:
     """Parse telemetry log into structured tool calls."""
@@ -28,40 +96,38 @@ def parse_tool_calls(server_log: str) -> list[dict]:
     current_tool = None
     current_args = None
 
-    for line in server_log.split("\n"):
+    # Iterate lines lazily rather than materializing a list of the whole log
+    for line in io.StringIO(server_log):
         line = line.strip()
 
+        # Most server log lines are not telemetry; skip them before any regex work
+        if not line.startswith("[TELEMETRY] "):
+            continue
+
+        m = _TELEMETRY_RE.match(line)
+        if not m:
+            continue  # e.g. "Tool executed successfully"; the output follows on its own line
+        kind = m.lastgroup
+
         # Tool name
-        m = re.match(r"\[TELEMETRY\] Tool: (.+)", line)
-        if m:
-            current_tool = m.group(1)
+        if kind == "tool":
+            current_tool = m.group("tool")
             current_args = None
-            continue
 
         # Tool args
-        m = re.match(r"\[TELEMETRY\] Args: (.+)", line)
-        if m:
-            try:
-                current_args = eval(m.group(1))  # safe: our own telemetry output
-            except Exception:
-                current_args = m.group(1)
-            continue
-
-        # Tool executed = end of this call
-        m = re.match(r"\[TELEMETRY\] Tool executed successfully: (.+)", line)
-        if m and current_tool:
-            # Check for output on next lines - look ahead
-            continue
+        elif kind == "args":
+            current_args = parse_args_repr(m.group("args"))
 
         # Output line
-        m = re.match(r"\[TELEMETRY\] Output \((\d+) bytes\): (.+)", line)
-        if m and current_tool:
-            output_size = int(m.group(1))
-            output_raw = m.group(2)
+        elif current_tool:
+            output_size = int(m.group("size"))
+            output_raw = m.group("output")
 
-            # Check if it was an error
-            is_error = '"error"' in output_raw[:300] and "timed out" in output_raw[:300]
-            has_data = '"data"' in output_raw[:300] and '"error"' not in output_raw[:300]
+            # Check if it was an error (both flags only look at the head of the output)
+            head = output_raw[:300]
+            has_error = '"error"' in head
+            is_error = has_error and "timed out" in head
+            has_data = not has_error and '"data"' in head
 
             call = {
                 "tool": current_tool,
@@ -126,29 +192,50 @@ def detect_dataset_used(calls: list[dict]) -> str:
     return ""
 
 
-def got_data(calls: list[dict]) -> bool:
-    """Check if any get_data call returned actual data."""
-    for call in calls:
-        if call["tool"] == "4_get_data" and call.get("has_data"):
-            return True
-    return False
+def last_output(tool_all_calls: dict, tool_name: str) -> str:
+    """Output of the last call to `tool_name`, or "" if it was never called."""
+    tool_calls = tool_all_calls.get(tool_name)
+    return tool_calls[-1]["output"] if tool_calls else ""
 
 
-def had_timeout(calls: list[dict]) -> bool:
-    """Check if any call had a timeout error."""
-    for call in calls:
-        if call.get("is_error"):
-            return True
-    return False
+def load_results(f) -> tuple[str, Iterable[dict]]:
+    """Return (dataset, results) from a results file opened in binary mode.
+
+    With ijson installed, results are streamed one at a time, so memory is
+    bounded by the largest single result rather than the whole file.
+    """
+    if ijson:
+        dataset = next(ijson.items(f, "dataset"), "")
+        f.seek(0)
+        return dataset, ijson.items(f, "results.item", use_float=True)
+    data = _json_loads(f.read())
+    return data.get("dataset", ""), data.get("results", [])
 
 
-def parse_json_file(json_path: Path) -> list[dict]:
-    """Parse a single JSON results file into rows."""
-    with open(json_path, "r", encoding="utf-8") as f:
-        data = json.load(f)
+def load_results_log(f) -> tuple[str, Iterator[dict]]:
+    """Return (dataset, results) from a tester's .jsonl results log opened in binary mode.
 
-    dataset = data.get("dataset", "")
+    Used for runs killed before they wrote their aggregate .json. The first line
+    holds the run metadata and every later line one result; a line torn by the
+    kill is skipped.
+    """
+    try:
+        meta = _json_loads(f.readline())
+    except ValueError:
+        meta = {}
+
+    def results():
+        for line in f:
+            try:
+                yield _json_loads(line)
+            except ValueError:
+                continue
 
+    return meta.get("dataset", ""), results()
+
+
+def parse_json_file(json_path: Path) -> Iterator[dict]:
+    """Parse a single JSON results file, yielding one row per result."""
     # Extract platform and mode from filename (e.g., chatgpt_PLFS_single_20260201_123456.json)
     fname = json_path.stem
     if fname.startswith("chatgpt_"):
@@ -159,71 +246,117 @@ def parse_json_file(json_path: Path) -> list[dict]:
         platform = "unknown"
 
     mode = "multi" if "_multi_" in fname else "single"
-    rows = []
-
-    for result in data.get("results", []):
-        calls = parse_tool_calls(result.get("server_log", ""))
-        get_data_filters = extract_get_data_args(calls)
-
-        # Clean response text
-        response = result.get("response_text", "")
-        response_short = response[:500].replace("\n", " ").strip()
-        if len(response) > 500:
-            response_short += "..."
-
-        # Collect ALL calls per tool type (there may be retries)
-        tool_all_outputs = {}
-        tool_all_calls = {}
-        for c in calls:
-            tool_name = c["tool"]
-            if tool_name not in tool_all_outputs:
-                tool_all_outputs[tool_name] = []
-                tool_all_calls[tool_name] = []
-            tool_all_outputs[tool_name].append(c.get("output", ""))
-            tool_all_calls[tool_name].append({
-                "args": c.get("args", {}),
-                "output": c.get("output", ""),
-                "has_data": c.get("has_data", False),
-                "is_error": c.get("is_error", False),
-            })
-
-        # For CSV: last output per tool (readable), plus all_calls JSON for judge
-        know_output = (tool_all_outputs.get("1_know_about_mospi_api") or [""])[-1]
-        indicators_output = (tool_all_outputs.get("2_get_indicators") or [""])[-1]
-        metadata_output = (tool_all_outputs.get("3_get_metadata") or [""])[-1]
-        data_output = (tool_all_outputs.get("4_get_data") or [""])[-1]
-
-        # All calls summary for judge (JSON of all calls with args + truncated output)
-        all_calls_json = json.dumps(tool_all_calls, ensure_ascii=False, default=str)
-
-        row = {
-            "platform": platform,
-            "mode": mode,
-            "dataset": dataset,
-            "no": result.get("no", ""),
-            "query": result.get("query", ""),
-            "indicator_tested": result.get("indicator_tested", ""),
-            "filters_tested": result.get("filters_tested", ""),
-            "status": result.get("status", ""),
-            "dataset_routed_to": detect_dataset_used(calls),
-            "correct_routing": "YES" if detect_dataset_used(calls) == dataset else ("WRONG" if detect_dataset_used(calls) else "N/A"),
-            "num_tool_calls": len(calls),
-            "tool_trace": summarize_tool_trace(calls),
-            "reached_get_data": "YES" if any(c["tool"] == "4_get_data" for c in calls) else "NO",
-            "got_data": "YES" if got_data(calls) else "NO",
-            "had_timeout": "YES" if had_timeout(calls) else "NO",
-            "get_data_filters": json.dumps(get_data_filters, ensure_ascii=False) if get_data_filters else "",
-            "1_know_output": know_output,
-            "2_indicators_output": indicators_output,
-            "3_metadata_output": metadata_output,
-            "4_data_output": data_output,
-            "all_tool_calls": all_calls_json,
-            "response_short": response_short,
-            "response_full": response.replace("\n", "\\n"),
-        }
-        rows.append(row)
-
-    return rows
+
+    with open(json_path, "rb") as f:
+        dataset, results = load_results_log(f) if json_path.suffix == ".jsonl" else load_results(f)
+
+        for result in results:
+            calls = parse_tool_calls(result.get("server_log", ""))
+            get_data_filters = extract_get_data_args(calls)
+
+            # Clean response text
+            response = result.get("response_text", "")
+            if response:
+                response_short = response[:500].replace("\n", " ").strip()
+                if len(response) > 500:
+                    response_short += "..."
+                response_full = response.replace("\n", "\\n")
+            else:
+                response_short = response_full = ""
+
+            # Collect ALL calls per tool type (there may be retries), noting in
+            # the same pass whether get_data was reached / returned data and
+            # whether any call errored
+            tool_all_calls = defaultdict(list)
+            reached_get_data = got_data = had_timeout = False
+            for c in calls:
+                tool_name = c["tool"]
+                if tool_name == "4_get_data":
+                    reached_get_data = True
+                    if c.get("has_data"):
+                        got_data = True
+                if c.get("is_error"):
+                    had_timeout = True
+                tool_all_calls[tool_name].append({
+                    "args": c.get("args", {}),
+                    "output": c.get("output", ""),
+                    "has_data": c.get("has_data", False),
+                    "is_error": c.get("is_error", False),
+                })
+
+            # For CSV: last output per tool (readable), plus all_calls JSON for judge
+            know_output = last_output(tool_all_calls, "1_know_about_mospi_api")
+            indicators_output = last_output(tool_all_calls, "2_get_indicators")
+            metadata_output = last_output(tool_all_calls, "3_get_metadata")
+            data_output = last_output(tool_all_calls, "4_get_data")
+
+            dataset_routed_to = detect_dataset_used(calls)
+
+            # All calls summary for judge (JSON of all calls with args + truncated output)
+            all_calls_json = _json_dumps_compact(tool_all_calls)
+
+            row = {
+                "platform": platform,
+                "mode": mode,
+                "dataset": dataset,
+                "no": result.get("no", ""),
+                "query": result.get("query", ""),
+                "indicator_tested": result.get("indicator_tested", ""),
+                "filters_tested": result.get("filters_tested", ""),
+                "status": result.get("status", ""),
+                "dataset_routed_to": dataset_routed_to,
+                "correct_routing": "YES" if dataset_routed_to == dataset else ("WRONG" if dataset_routed_to else "N/A"),
+                "num_tool_calls": len(calls),
+                "tool_trace": summarize_tool_trace(calls),
+                "reached_get_data": "YES" if reached_get_data else "NO",
+                "got_data": "YES" if got_data else "NO",
+                "had_timeout": "YES" if had_timeout else "NO",
+                "get_data_filters": _json_dumps_compact(get_data_filters) if get_data_filters else "",
+                "1_know_output": know_output,
+                "2_indicators_output": indicators_output,
+                "3_metadata_output": metadata_output,
+                "4_data_output": data_output,
+                "all_tool_calls": all_calls_json,
+                "response_short": response_short,
+                "response_full": response_full,
+            }
+            yield row
+
+
+def spool_json_file(json_path: Path, spool_dir: str) -> str:
+    """Parse a file in a worker process, pickling its rows one at a time into spool_dir.
+
+    Returns the spool file's path; the parent reads rows back with
+    iter_spooled_rows, so neither process holds a whole file's rows.
+    """
+    with tempfile.NamedTemporaryFile("wb", dir=spool_dir, suffix=".pickle", delete=False) as f:
+        for row in parse_json_file(json_path):
+            pickle.dump(row, f, pickle.HIGHEST_PROTOCOL)
+    return f.name
+
+
+def iter_spooled_rows(spool_path: str) -> Iterator[dict]:
+    """Yield the rows spool_json_file wrote, deleting the spool file once read."""
+    with open(spool_path, "rb") as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                break
+    os.unlink(spool_path)
+
+
+def iter_parsed_files(json_files: list[Path], workers: int):
+    """Yield (path, rows) for each file in order, parsing in worker processes when workers > 1."""
+    if workers <= 1 or len(json_files) <= 1:
+        for jf in json_files:
+            yield jf, parse_json_file(jf)
+        return
+    with tempfile.TemporaryDirectory(prefix="parse_results_") as spool_dir, \
+            ProcessPoolExecutor(max_workers=min(workers, len(json_files))) as executor:
+        spools = executor.map(spool_json_file, json_files, repeat(spool_dir))
+        for jf, spool_path in zip(json_files, spools):
+            yield jf, iter_spooled_rows(spool_path)
 
 
 def main():
@@ -231,52 +364,42 @@ def main():
     parser = argparse.ArgumentParser(description="Parse MCP tester JSON results into CSV")
     parser.add_argument("--dir", type=str, default=None,
                         help="Directory containing JSON files and for output CSV (default: responses/)")
-    parser.add_argument("files", nargs="*", help="JSON files to parse (optional, defaults to all in --dir)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Parse files in this many processes; 1 parses in-process (default: CPU count)")
+    parser.add_argument("files", nargs="*", help="JSON (or .jsonl results log) files to parse (optional, defaults to all in --dir)")
     args = parser.parse_args()
 
     # Determine working directory
     work_dir = Path(args.dir) if args.dir else RESPONSES_DIR
 
-    # Find JSON files to parse
+    # Find JSON files to parse, as (mtime, path) so each file is stat'ed once
     if args.files:
-        json_files = [Path(p) for p in args.files]
+        stamped = [(p.stat().st_mtime, p) for p in map(Path, args.files)]
     else:
-        # Find latest JSON per dataset in work_dir
-        all_jsons = sorted(work_dir.glob("*.json"), key=lambda p: p.stat().st_mtime)
-        # Group by dataset prefix, keep latest
+        # Keep the latest JSON per dataset prefix in work_dir in a single pass
         latest = {}
-        for f in all_jsons:
+        # A .jsonl without its .json is the results log of a run that was killed
+        logs = (f for f in work_dir.glob("*.jsonl") if not f.with_suffix(".json").exists())
+        for f in chain(work_dir.glob("*.json"), logs):
             prefix = f.stem.rsplit("_", 2)[0]  # e.g., "PLFS" from "PLFS_20260131_171044"
-            latest[prefix] = f
-        json_files = list(latest.values())
+            mtime = f.stat().st_mtime
+            current = latest.get(prefix)
+            if current is None or mtime >= current[0]:
+                latest[prefix] = (mtime, f)
+        stamped = list(latest.values())
 
-    if not json_files:
+    if not stamped:
         print(f"No JSON files found in {work_dir}")
         return
 
     # Sort files by modification time so newer files override older ones
-    json_files.sort(key=lambda p: p.stat().st_mtime)
+    stamped.sort(key=itemgetter(0))
+    json_files = [f for _, f in stamped]
 
     print(f"Parsing {len(json_files)} files:")
     for f in json_files:
         print(f"  {f.name}")
 
-    all_rows = []
-    for jf in json_files:
-        rows = parse_json_file(jf)
-        all_rows.extend(rows)
-        print(f"  {jf.name}: {len(rows)} queries")
-
-    # Deduplicate: for same (dataset, no), keep the LAST occurrence (from latest file)
-    seen = {}
-    for i, row in enumerate(all_rows):
-        key = (row["dataset"], row["no"])
-        seen[key] = i  # overwrite with latest index
-    deduped_rows = [all_rows[i] for i in sorted(seen.values())]
-    if len(deduped_rows) < len(all_rows):
-        print(f"\n  Deduplicated: {len(all_rows)} -> {len(deduped_rows)} rows (removed {len(all_rows) - len(deduped_rows)} duplicates)")
-    all_rows = deduped_rows
-
     # Write CSV to work_dir
     out_path = work_dir / "benchmark_results.csv"
     fieldnames = [
@@ -289,43 +412,83 @@ def main():
         "response_short", "response_full",
     ]
 
-    with open(out_path, "w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(all_rows)
+    # Deduplicate: for the same (dataset, no), keep the LAST occurrence (files
+    # are in mtime order, so that's the one from the latest file) at its own
+    # position. Rows are written to a temp file as they are parsed; only if a
+    # key repeated is it copied over again without the superseded rows. The
+    # summary only keeps counters per (platform, mode, dataset).
+    winner = {}  # (dataset, no) -> (row index, summary cell, got data, timed out, routed)
+    n_parsed = 0
+    # Plain csv.writer on tuples pulled in fieldnames order; DictWriter would
+    # re-check and re-order every row's keys
+    row_values = itemgetter(*fieldnames)
+    tmp_path = out_path.with_name(out_path.name + ".tmp")
+    with open(tmp_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(fieldnames)
+        for jf, rows in iter_parsed_files(json_files, args.workers):
+            count = 0
+            for row in rows:
+                writer.writerow(row_values(row))
+                winner[(row["dataset"], row["no"])] = (
+                    n_parsed + count,
+                    (row["platform"], row["mode"], row["dataset"]),
+                    row["got_data"] == "YES",
+                    row["had_timeout"] == "YES",
+                    row["correct_routing"] == "YES",
+                )
+                count += 1
+            n_parsed += count
+            print(f"  {jf.name}: {count} queries")
+
+    n_rows = len(winner)
+    if n_rows < n_parsed:
+        keep = {row_idx for row_idx, *_ in winner.values()}
+        csv.field_size_limit(2**31 - 1)  # Read back fields of any size we just wrote
+        with open(tmp_path, newline="", encoding="utf-8") as fin, \
+                open(out_path, "w", newline="", encoding="utf-8") as fout:
+            reader = csv.reader(fin)
+            writer = csv.writer(fout)
+            writer.writerow(next(reader))
+            writer.writerows(row for row_idx, row in enumerate(reader) if row_idx in keep)
+        os.unlink(tmp_path)
+        print(f"\n  Deduplicated: {n_parsed} -> {n_rows} rows (removed {n_parsed - n_rows} duplicates)")
+    else:
+        os.replace(tmp_path, out_path)
+
+    totals = Counter()
+    got = Counter()
+    timeouts = Counter()
+    correct = Counter()
+    for _, cell, has_data, timed_out, routed in winner.values():
+        totals[cell] += 1
+        got[cell] += has_data
+        timeouts[cell] += timed_out
+        correct[cell] += routed
 
     print(f"\nCSV written to: {out_path}")
-    print(f"Total rows: {len(all_rows)}")
+    print(f"Total rows: {n_rows}")
 
     # Print quick summary
     print("\n--- Summary ---")
-    platforms = sorted(set(r["platform"] for r in all_rows))
-    modes = sorted(set(r["mode"] for r in all_rows))
+    platforms = sorted(set(plat for plat, _, _ in totals))
+    modes = sorted(set(m for _, m, _ in totals))
     print(f"Platforms: {', '.join(platforms)}")
     print(f"Modes: {', '.join(modes)}")
     print()
 
-    datasets = sorted(set(r["dataset"] for r in all_rows))
     print(f"{'Platform':<10} {'Mode':<8} {'Dataset':<10} {'Total':>5} {'Data':>5} {'Timeout':>7} {'Routing':>8}")
     print("-" * 65)
-    for plat in platforms:
-        for m in modes:
-            for ds in datasets:
-                rows = [r for r in all_rows if r["platform"] == plat and r["mode"] == m and r["dataset"] == ds]
-                if not rows:
-                    continue
-                total = len(rows)
-                got = sum(1 for r in rows if r["got_data"] == "YES")
-                timeout = sum(1 for r in rows if r["had_timeout"] == "YES")
-                correct = sum(1 for r in rows if r["correct_routing"] == "YES")
-                print(f"{plat:<10} {m:<8} {ds:<10} {total:>5} {got:>5} {timeout:>7} {correct:>5}/{total}")
-
-    totals = len(all_rows)
-    total_got = sum(1 for r in all_rows if r["got_data"] == "YES")
-    total_timeout = sum(1 for r in all_rows if r["had_timeout"] == "YES")
-    total_correct = sum(1 for r in all_rows if r["correct_routing"] == "YES")
+    for cell in sorted(totals):
+        plat, m, ds = cell
+        total = totals[cell]
+        print(f"{plat:<10} {m:<8} {ds:<10} {total:>5} {got[cell]:>5} {timeouts[cell]:>7} {correct[cell]:>5}/{total}")
+
+    total_got = sum(got.values())
+    total_timeout = sum(timeouts.values())
+    total_correct = sum(correct.values())
     print("-" * 65)
-    print(f"{'TOTAL':<10} {'':<8} {'':<10} {totals:>5} {total_got:>5} {total_timeout:>7} {total_correct:>5}/{totals}")
+    print(f"{'TOTAL':<10} {'':<8} {'':<10} {n_rows:>5} {total_got:>5} {total_timeout:>7} {total_correct:>5}/{n_rows}")
 
 
 if __name__ == "__main__":
@@ -28,15 +28,15 @@ echo "Running ChatGPT tests: $MODE"
 echo "Datasets: $DATASETS"
 echo ""
 
+# One browser session for every dataset: each line is "<csv> <dataset>"
 for ds in $DATASETS; do
     CSV="queries/chatgpt/${MODE}/test_queries_${ds}.csv"
     if [[ ! -f "$CSV" ]]; then
-        echo "WARNING: $CSV not found, skipping $ds"
+        echo "WARNING: $CSV not found, skipping $ds" >&2
         continue
     fi
-    echo ">>> $ds at $(date)"
-    python testers/chatgpt_tester.py --dataset "$ds" --csv "$CSV" --server-log "$LOG" --delay 60
-done
+    echo "$CSV $ds"
+done | python testers/chatgpt_tester.py --serve --server-log "$LOG" --delay 60
 
 echo ""
 echo "Done! Results in responses/"
@@ -17,17 +17,24 @@ Usage:
 
     # Also take screenshots
     python chatgpt_tester.py --dataset PLFS --csv queries/chatgpt/test_queries_PLFS.csv --server-log /tmp/mospi_telemetry.log --screenshots
+
+    # Run several CSVs in one browser session (path and optional dataset tag per line)
+    printf '%s\n' queries/chatgpt/test_queries_PLFS.csv queries/chatgpt/test_queries_CPI.csv | python chatgpt_tester.py --serve --server-log /tmp/mospi_telemetry.log
 """
 
 import argparse
-import csv
-import json
 import sys
 import time
+from contextlib import nullcontext
 from datetime import datetime
 from pathlib import Path
 
-from playwright.sync_api import sync_playwright, TimeoutError as PwTimeout
+from playwright.sync_api import sync_playwright, expect, TimeoutError as PwTimeout
+
+from tester_common import (
+    LIMIT_BANNER_RE, LogTail, ResultsLog, TesterSession,
+    count_queries, iter_queries, last_message_length, limit_banner_visible, serve,
+)
 
 BASE_DIR = Path(__file__).parent.parent
 SCREENSHOTS_DIR = BASE_DIR / "screenshots"
@@ -42,22 +49,36 @@ SELECTORS = {
     "stop_btn": 'button[aria-label="Stop generating"]',
     "assistant_msg": 'div[data-message-author-role="assistant"]',
     "attach_btn": 'button[data-testid="composer-plus-btn"]',
+    "more_menu": 'div[role="menuitem"][data-has-submenu]',
     "new_chat": 'a[data-testid="create-new-chat-button"]',
+    # Any user or assistant turn in the conversation
+    "chat_message": '[data-message-author-role], article[data-testid^="conversation-turn"]',
+    # Connector already attached to the composer (format with name=)
+    "attached_connector": 'form [data-testid="attached-connector-{name}"]',
 }
 
 # MCP connector name to look for in the attach menu
 MCP_CONNECTOR_NAME = "mospi_V1"
 
 
-def read_server_log(log_path: str) -> str:
-    """Read current contents of server telemetry log."""
-    if not log_path:
-        return ""
-    try:
-        with open(log_path, "r") as f:
-            return f.read()
-    except FileNotFoundError:
-        return ""
+class PageHandles:
+    """
+    Locators for the chat UI, built once per page and reused for every query.
+
+    Locators are lazy and re-resolve on each use, so they stay valid across
+    start_new_chat navigations.
+    """
+
+    def __init__(self, page):
+        self.page = page
+        self.composer = page.locator(SELECTORS["composer"])
+        self.send = page.locator(SELECTORS["send_btn"])
+        self.stop = page.locator(SELECTORS["stop_btn"])
+        self.assistant = page.locator(SELECTORS["assistant_msg"])
+        self.attach = page.locator(SELECTORS["attach_btn"])
+        self.more = page.locator(SELECTORS["more_menu"])
+        self.limit_banner = page.get_by_text(LIMIT_BANNER_RE)
+        self.message_selector = SELECTORS["chat_message"]  # Banner matches in here are chat text
 
 
 def save_auth():
@@ -91,14 +112,16 @@ def save_auth():
         print(f"Auth saved to {AUTH_DIR}")
 
 
-def wait_for_response(page, timeout_ms=180_000):
+def wait_for_response(ui, timeout_ms=180_000):
     """
     Wait until ChatGPT finishes generating.
 
     1. Wait for stop button or assistant message to appear (generation started).
     2. Wait for stop button to disappear (generation done).
-    3. Extra settle time for rendering.
+    3. Wait for the response text to stop changing (rendering done).
     """
+    page = ui.page
+
     # Wait for generation to start
     try:
         page.wait_for_selector(
@@ -107,7 +130,7 @@ def wait_for_response(page, timeout_ms=180_000):
             timeout=120_000,
         )
     except PwTimeout:
-        if not page.query_selector(SELECTORS["assistant_msg"]):
+        if ui.assistant.count() == 0:
             print("    [warn] No response detected within 120s")
             return False
 
@@ -123,42 +146,73 @@ def wait_for_response(page, timeout_ms=180_000):
         return False
 
     # Let final content settle (MCP responses can be long)
-    time.sleep(15)
+    if not wait_for_quiescence(ui):
+        print("    [warn] Response text still changing after settle timeout")
     return True
 
 
-def get_response_text(page):
+def wait_for_quiescence(ui, timeout_s=60, stable_checks=3, interval=0.5, max_interval=2.0):
+    """
+    Wait until the last assistant message stops changing.
+
+    Samples the response length and returns as soon as it is unchanged for
+    `stable_checks` checks in a row with no stop button on the page. While the
+    text is still changing the sampling interval doubles, up to `max_interval`.
+    """
+    deadline = time.monotonic() + timeout_s
+    delay = interval
+    last_len = -1
+    stable = 0
+    while time.monotonic() < deadline:
+        length = last_message_length(ui)
+        if length >= 0 and length == last_len and ui.stop.count() == 0:
+            stable += 1
+            if stable >= stable_checks:
+                return True
+            delay = interval
+        else:
+            stable = 0
+            last_len = length
+            delay = min(delay * 2, max_interval)
+        time.sleep(delay)
+    return False
+
+
+def get_response_text(ui):
     """Extract the last assistant message text from the page."""
-    messages = page.locator(SELECTORS["assistant_msg"])
+    messages = ui.assistant
     count = messages.count()
     if count == 0:
         return ""
     return messages.nth(count - 1).inner_text()
 
 
-def attach_mcp_connector(page, connector_name=MCP_CONNECTOR_NAME):
+def attach_mcp_connector(ui, connector_name=MCP_CONNECTOR_NAME):
     """Click +, then More, then select the MCP connector from dropdown."""
     try:
+        # Attachment often survives a new chat; skip the menus if it's already there
+        attached = ui.page.locator(SELECTORS["attached_connector"].format(name=connector_name)).first
+        if attached.count() and attached.is_visible():
+            print(f"    MCP connector '{connector_name}' already attached")
+            return True
+
         # Step 1: Click the + button
-        plus_btn = page.locator(SELECTORS["attach_btn"])
+        plus_btn = ui.attach
         plus_btn.wait_for(state="visible", timeout=10_000)
         plus_btn.click()
-        time.sleep(1)
 
         # Step 2: Hover on "More" to open submenu
-        more_btn = page.locator('div[role="menuitem"][data-has-submenu]')
-        more_btn.wait_for(state="visible", timeout=5_000)
+        more_btn = ui.more
+        expect(more_btn).to_be_visible(timeout=5_000)
         more_btn.hover()
-        time.sleep(1.5)
 
         # Step 3: Click the MCP connector in the submenu
-        connector = page.get_by_text(connector_name, exact=False)
-        connector.wait_for(state="visible", timeout=5_000)
+        connector = ui.page.get_by_text(connector_name, exact=False)
+        expect(connector).to_be_enabled(timeout=5_000)
         connector.click()
-        time.sleep(1)
         print(f"    MCP connector '{connector_name}' attached")
         return True
-    except PwTimeout:
+    except (PwTimeout, AssertionError):
         print(f"    [warn] Could not find MCP connector '{connector_name}'")
         return False
     except Exception as e:
@@ -166,23 +220,50 @@ def attach_mcp_connector(page, connector_name=MCP_CONNECTOR_NAME):
         return False
 
 
-def send_query(page, query_text):
+def take_screenshot(ui, path, full_page=False):
+    """Screenshot the last assistant message, or the whole scrolled page with full_page=True."""
+    page = ui.page
+    if full_page:
+        page.evaluate("window.scrollTo(0, 0)")
+        time.sleep(1)
+        page.screenshot(path=str(path), full_page=True)
+        return
+    messages = ui.assistant
+    count = messages.count()
+    if count:
+        messages.nth(count - 1).screenshot(path=str(path))
+    else:
+        page.screenshot(path=str(path))  # Nothing rendered; keep the viewport for debugging
+
+
+def send_query(ui, query_text):
     """Type a query into the composer and send it."""
-    composer = page.locator(SELECTORS["composer"])
+    composer = ui.composer
     composer.click()
-    composer.fill("")
-    time.sleep(0.3)
-    composer.fill(query_text)
-    time.sleep(0.5)
+    expect(composer).to_be_focused(timeout=5_000)
+    composer.fill(query_text)  # Replaces any existing draft
 
-    send = page.locator(SELECTORS["send_btn"])
-    send.click()
+    expect(ui.send).to_be_enabled(timeout=5_000)
+    ui.send.click()
 
 
 def start_new_chat(page):
-    """Navigate to a fresh chat."""
-    page.goto("https://chatgpt.com/", wait_until="networkidle")
-    time.sleep(2)
+    """
+    Open a fresh chat.
+
+    Uses the app's own new-chat link when the app is already loaded, so the
+    SPA isn't reloaded for every query; falls back to a full page load.
+    """
+    if page.url.startswith("https://chatgpt.com"):
+        try:
+            page.locator(SELECTORS["new_chat"]).first.click(timeout=5_000)
+            page.wait_for_url(lambda url: "/c/" not in url, timeout=10_000)
+            # The previous conversation must be gone before we watch for a new response
+            page.locator(SELECTORS["assistant_msg"]).first.wait_for(state="detached", timeout=10_000)
+            return
+        except Exception as e:
+            print(f"    [debug] In-app new chat failed, reloading: {e}")
+    page.goto("https://chatgpt.com/", wait_until="domcontentloaded")
 
 
 def run_queries(
@@ -192,32 +273,29 @@ def run_queries(
     start_from=1,
     headless=False,
     take_screenshots=False,
+    full_page_screenshot=False,
     mcp_name=MCP_CONNECTOR_NAME,
     query_delay=60,
+    max_delay=600,
+    session=None,
 ):
     """Read CSV, send each query, capture response text, server log, and optionally screenshot."""
     RESPONSES_DIR.mkdir(exist_ok=True)
     if take_screenshots:
         SCREENSHOTS_DIR.mkdir(exist_ok=True)
 
-    queries = []
-    with open(csv_path, newline="", encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            queries.append(row)
-
-    if not queries:
+    total = count_queries(csv_path)
+    if not total:
         print("No queries found in CSV.")
         return
 
     tag = dataset_tag or Path(csv_path).stem
     # Detect mode from path
     mode = "multi" if "multiple" in csv_path else "single"
-    results = []
     # Filename: chatgpt_{dataset}_{mode}_{timestamp}.json
     results_path = RESPONSES_DIR / f"chatgpt_{tag}_{mode}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
 
-    print(f"Loaded {len(queries)} queries from {csv_path}")
+    print(f"Loaded {total} queries from {csv_path}")
     print(f"Starting from query #{start_from}")
     print(f"Responses -> {RESPONSES_DIR}/")
     if server_log:
@@ -226,45 +304,35 @@ def run_queries(
         print(f"Screenshots -> {SCREENSHOTS_DIR}/")
     print()
 
-    with sync_playwright() as p:
-        context = p.chromium.launch_persistent_context(
-            user_data_dir=str(AUTH_DIR),
-            headless=headless,
-            channel="chromium",
-            viewport={"width": 1440, "height": 900},
-            args=[
-                "--disable-blink-features=AutomationControlled",
-                "--no-sandbox",
-                "--disable-setuid-sandbox",
-            ],
-            ignore_default_args=["--enable-automation"],
-        )
-        page = context.pages[0] if context.pages else context.new_page()
-        page.set_default_timeout(60_000)
-
-        for qno, row in enumerate(queries, 1):
-            query_no = int(row.get("no", qno))
+    results_log = ResultsLog(results_path, tag, csv_path, total)
+    # Reuse the caller's browser (serve mode) or start one just for this CSV
+    session_cm = nullcontext(session) if session else TesterSession(
+        AUTH_DIR, PageHandles, headless, query_delay, max_delay)
+    with results_log, session_cm as session:
+        page = session.page
+        ui = session.ui
+        throttle = session.throttle
+        log_tail = LogTail(server_log)
+
+        for query_no, row in iter_queries(csv_path, start_from):
             query = row["query"]
 
-            if query_no < start_from:
-                continue
-
-            print(f"[{query_no}/{len(queries)}] {query[:80]}...")
+            print(f"[{query_no}/{total}] {query[:80]}...")
 
-            # Snapshot server log before query
-            log_before = read_server_log(server_log)
+            # Only telemetry logged from here on belongs to this query
+            log_tail.mark()
 
             start_new_chat(page)
 
             # Attach MCP connector
-            attach_mcp_connector(page, mcp_name)
+            attach_mcp_connector(ui, mcp_name)
 
             # Send query
             try:
-                send_query(page, query)
+                send_query(ui, query)
             except Exception as e:
                 print(f"    [ERROR] Failed to send: {e}")
-                results.append({
+                results_log.append({
                     "no": query_no,
                     "query": query,
                     "indicator_tested": row.get("indicator_tested", ""),
@@ -276,36 +344,26 @@ def run_queries(
                 })
                 continue
 
-            # Give ChatGPT time to start processing (MCP tool calls take time)
-            time.sleep(30)
-
             # Wait for response
-            success = wait_for_response(page, timeout_ms=180_000)
+            success = wait_for_response(ui, timeout_ms=180_000)
 
             # Capture response text
-            response_text = get_response_text(page)
+            response_text = get_response_text(ui)
             print(f"    Response: {response_text[:120]}...")
 
-            # Snapshot server log after
-            log_after = read_server_log(server_log)
-            new_log = ""
-            if log_after and log_before:
-                new_log = log_after[len(log_before):] if log_after.startswith(log_before) else log_after
-            elif log_after:
-                new_log = log_after
+            # Telemetry logged while this query ran
+            new_log = log_tail.read_new()
 
             # Optional screenshot
             ss_name = ""
             if take_screenshots:
-                page.evaluate("window.scrollTo(0, 0)")
-                time.sleep(1)
                 ss_name = f"{tag}_{query_no:02d}.png"
                 ss_path = SCREENSHOTS_DIR / ss_name
-                page.screenshot(path=str(ss_path), full_page=True)
+                take_screenshot(ui, ss_path, full_page=full_page_screenshot)
                 print(f"    Screenshot: {ss_path}")
 
             status = "PASS" if success else "TIMEOUT"
-            results.append({
+            results_log.append({
                 "no": query_no,
                 "query": query,
                 "indicator_tested": row.get("indicator_tested", ""),
@@ -316,26 +374,18 @@ def run_queries(
                 "screenshot": ss_name,
             })
 
-            # Save after each query
-            with open(results_path, "w", encoding="utf-8") as f:
-                json.dump({
-                    "dataset": tag,
-                    "csv": str(csv_path),
-                    "timestamp": datetime.now().isoformat(),
-                    "total_queries": len(queries),
-                    "results": results,
-                }, f, indent=2, ensure_ascii=False)
-
-            # Rate limit delay
-            if query_no < len(queries):
-                print(f"    Waiting {query_delay}s before next query...")
-                time.sleep(query_delay)
-
-        context.close()
+            # Rate limit delay: backs off while the service is throttling us
+            if limit_banner_visible(ui):
+                throttle.hit()
+            delay = throttle.next_delay()
+            if query_no < total:
+                print(f"    Waiting {delay:g}s before next query...")
+                time.sleep(delay)
 
     print(f"\nDone. Results -> {results_path}")
 
     # Print summary
+    results = results_log.results
     passed = sum(1 for r in results if r["status"] == "PASS")
     failed = sum(1 for r in results if r["status"] != "PASS")
     print(f"Summary: {passed} passed, {failed} failed/timeout out of {len(results)} run")
@@ -348,6 +398,9 @@ def main():
         help="Open browser to log in and save auth state.",
     )
     parser.add_argument("--csv", type=str, help="Path to queries CSV file")
+    parser.add_argument("--serve", action="store_true",
+                        help="Keep one browser open and run each CSV path read from stdin "
+                             "(one per line, optionally followed by a dataset tag)")
     parser.add_argument("--dataset", type=str, default=None,
                         help="Dataset tag for filenames (default: CSV stem)")
     parser.add_argument("--server-log", type=str, default="",
@@ -355,11 +408,15 @@ def main():
     parser.add_argument("--start", type=int, default=1,
                         help="Start from this query number (for resuming)")
     parser.add_argument("--delay", type=int, default=60,
-                        help="Delay between queries in seconds (default: 60)")
+                        help="Minimum delay between queries in seconds (default: 60)")
+    parser.add_argument("--max-delay", type=int, default=600,
+                        help="Cap for the delay when backing off on rate limits (default: 600)")
     parser.add_argument("--headless", action="store_true",
                         help="Run in headless mode")
     parser.add_argument("--screenshots", action="store_true",
                         help="Take screenshots (off by default)")
+    parser.add_argument("--full-page-screenshot", action="store_true",
+                        help="Screenshot the whole page instead of just the last response")
     parser.add_argument("--mcp-name", type=str, default=MCP_CONNECTOR_NAME,
                         help=f"MCP connector name to attach (default: {MCP_CONNECTOR_NAME})")
     args = parser.parse_args()
@@ -368,14 +425,25 @@ def main():
         save_auth()
         return
 
-    if not args.csv:
-        parser.error("--csv is required when not using --save-auth")
+    if not args.csv and not args.serve:
+        parser.error("--csv is required when not using --save-auth or --serve")
 
     if not AUTH_DIR.exists():
         print(f"Auth not found at {AUTH_DIR}")
         print("Run: python chatgpt_tester.py --save-auth")
         sys.exit(1)
 
+    if args.serve:
+        serve(
+            run_queries,
+            TesterSession(AUTH_DIR, PageHandles, args.headless, args.delay, args.max_delay),
+            server_log=args.server_log,
+            take_screenshots=args.screenshots,
+            full_page_screenshot=args.full_page_screenshot,
+            mcp_name=args.mcp_name,
+        )
+        return
+
     run_queries(
         args.csv,
         args.dataset,
@@ -383,8 +451,10 @@ def main():
         start_from=args.start,
         headless=args.headless,
         take_screenshots=args.screenshots,
+        full_page_screenshot=args.full_page_screenshot,
         mcp_name=args.mcp_name,
         query_delay=args.delay,
+        max_delay=args.max_delay,
     )
 
 
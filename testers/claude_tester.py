@@ -14,17 +14,24 @@ Usage:
 
     # Resume from a specific query number
     python tester_claude.py --dataset PLFS --csv queries_claude/claude_queries_PLFS.csv --server-log /tmp/mospi_telemetry.log --start 5
+
+    # Run several CSVs in one browser session (path and optional dataset tag per line)
+    printf '%s\n' queries_claude/claude_queries_PLFS.csv queries_claude/claude_queries_CPI.csv | python tester_claude.py --serve --server-log /tmp/mospi_telemetry.log
 """
 
 import argparse
-import csv
-import json
 import sys
 import time
+from contextlib import nullcontext
 from datetime import datetime
 from pathlib import Path
 
-from playwright.sync_api import sync_playwright, TimeoutError as PwTimeout
+from playwright.sync_api import sync_playwright, expect, TimeoutError as PwTimeout
+
+from tester_common import (
+    LIMIT_BANNER_RE, LogTail, ResultsLog, TesterSession,
+    count_queries, iter_queries, last_message_length, limit_banner_visible, serve,
+)
 
 BASE_DIR = Path(__file__).parent.parent
 SCREENSHOTS_DIR = BASE_DIR / "screenshots_claude"
@@ -41,18 +48,73 @@ SELECTORS = {
     "response_container": 'div.font-claude-message',
     "new_chat": 'a[href="/new"]',
     "integrations_btn": 'button[data-testid="integrations-menu-button"]',
+    # Any user or assistant turn in the conversation
+    "chat_message": ('[data-testid="user-message"], [data-testid="chat-message-content"], '
+                     'div[data-is-streaming], div.font-claude-message'),
 }
 
+# Stop buttons seen across Claude.ai UI versions, plus any button whose text contains STOP_TEXT
+STOP_SELECTORS = [
+    'button[aria-label="Stop Response"]',
+    'button[aria-label="Stop generating"]',
+]
+STOP_TEXT = "Stop"
+
+# Resolves true as soon as no stop button is visible, false after `timeout` ms.
+# A MutationObserver re-checks on every DOM change instead of polling.
+_STOP_GONE_JS = """([selectors, stopText, timeout]) => new Promise(resolve => {
+    const visible = el => el.getClientRects().length > 0 && getComputedStyle(el).visibility !== "hidden";
+    const needle = stopText.toLowerCase();
+    const generating = () =>
+        selectors.some(sel => [...document.querySelectorAll(sel)].some(visible)) ||
+        [...document.querySelectorAll("button")].some(b => b.textContent.toLowerCase().includes(needle) && visible(b));
+    if (!generating()) return resolve(true);
+    const observer = new MutationObserver(() => {
+        if (!generating()) { clearTimeout(timer); observer.disconnect(); resolve(true); }
+    });
+    const timer = setTimeout(() => { observer.disconnect(); resolve(false); }, timeout);
+    observer.observe(document.body, {childList: true, subtree: true, attributes: true, characterData: true});
+})"""
+
+
+# Containers that hold response content across Claude.ai UI versions
+RESPONSE_SELECTORS = [
+    '[data-testid="chat-message-content"]',
+    'div.font-claude-message',
+    'div[data-is-streaming]',
+    '[data-testid="assistant-message"]',
+    'div.prose',  # Common markdown container
+]
+
+# Send buttons seen across Claude.ai UI versions, tried in order
+SEND_SELECTORS = [
+    'button[aria-label="Send Message"]',
+    'button[type="submit"]',
+    'button:has-text("Send")',
+]
+
+
+class PageHandles:
+    """
+    Locators for the chat UI, built once per page and reused for every query.
 
-def read_server_log(log_path: str) -> str:
-    """Read current contents of server telemetry log."""
-    if not log_path:
-        return ""
-    try:
-        with open(log_path, "r") as f:
-            return f.read()
-    except FileNotFoundError:
-        return ""
+    Locators are lazy and re-resolve on each use, so they stay valid across
+    start_new_chat navigations.
+    """
+
+    def __init__(self, page):
+        self.page = page
+        self.composer = page.locator('div[contenteditable="true"]').first
+        self.send_buttons = [page.locator(sel).first for sel in SEND_SELECTORS]
+        self.send_any = page.locator(", ".join(SEND_SELECTORS)).first
+        self.stop_buttons = [page.locator(sel).first
+                             for sel in STOP_SELECTORS + [f'button:has-text("{STOP_TEXT}")']]
+        self.assistant = page.locator(SELECTORS["assistant_msg"])
+        self.paragraphs = page.locator('p.font-claude-response-body')
+        self.response_container = page.locator(SELECTORS["response_container"])
+        self.main = page.locator('main').first
+        self.limit_banner = page.get_by_text(LIMIT_BANNER_RE)
+        self.message_selector = SELECTORS["chat_message"]  # Banner matches in here are chat text
 
 
 def save_auth():
@@ -86,99 +148,108 @@ def save_auth():
         print(f"Auth saved to {AUTH_DIR}")
 
 
-def wait_for_response(page, timeout_ms=180_000):
+def wait_for_response(ui, timeout_ms=180_000):
     """
     Wait until Claude finishes generating.
 
     1. Wait for any response content to appear.
     2. Wait for streaming to stop.
-    3. Extra settle time for rendering.
+    3. Wait for the response text to stop changing (rendering done).
     """
-    # Multiple selectors to detect response start
-    response_selectors = [
-        '[data-testid="chat-message-content"]',
-        'div.font-claude-message',
-        'div[data-is-streaming]',
-        '[data-testid="assistant-message"]',
-        'div.prose',  # Common markdown container
-    ]
-
-    # Wait for response to start - try multiple selectors
-    response_found = False
-    for selector in response_selectors:
-        try:
-            page.wait_for_selector(selector, state="attached", timeout=10_000)
-            response_found = True
-            print(f"    [debug] Response detected via: {selector}")
-            break
-        except PwTimeout:
-            continue
-
-    if not response_found:
-        # Last resort: wait a bit and check if page content changed
-        print("    [warn] No response selector matched, waiting 30s...")
-        time.sleep(30)
-
-    # Poll for streaming to finish (can't use wait_for_function due to CSP)
-    # Look for stop button to disappear
-    start_time = time.time()
-    while time.time() - start_time < timeout_ms / 1000:
-        # Multiple stop button selectors
-        stop_selectors = [
-            'button[aria-label="Stop Response"]',
-            'button[aria-label="Stop generating"]',
-            'button:has-text("Stop")',
-        ]
-        stop_visible = False
-        for sel in stop_selectors:
-            try:
-                btn = page.locator(sel).first
-                if btn.count() > 0 and btn.is_visible():
-                    stop_visible = True
-                    break
-            except:
-                continue
+    page = ui.page
 
-        if not stop_visible:
-            # No stop button visible = done streaming
-            break
-        time.sleep(2)
-    else:
+    # Wait for generation to start: a stop button or any response container,
+    # whichever attaches first
+    try:
+        page.wait_for_selector(
+            ", ".join(STOP_SELECTORS + RESPONSE_SELECTORS),
+            state="attached",
+            timeout=15_000,
+        )
+    except PwTimeout:
+        print("    [warn] No response detected within 15s")
+
+    # Wait for streaming to finish: the stop button disappears
+    stopped = wait_for_stop_hidden(page, timeout_ms)
+    if stopped is None:
+        # Observer unavailable: poll instead (can't use wait_for_function due to CSP)
+        start_time = time.time()
+        while time.time() - start_time < timeout_ms / 1000:
+            if not stop_visible(ui):
+                # No stop button visible = done streaming
+                stopped = True
+                break
+            time.sleep(2)
+    if not stopped:
         print("    [warn] Response still generating after timeout")
         return False
 
-    # Let final content settle - wait until paragraph count stabilizes
+    # Let final content settle
     print("    [debug] Waiting for content to stabilize...")
-    time.sleep(5)
-    last_para_count = 0
-    stable_count = 0
-    for _ in range(45):  # Max 90 seconds additional wait
+    if not wait_for_quiescence(ui):
+        print("    [warn] Response text still changing after settle timeout")
+    return True
+
+
+def wait_for_stop_hidden(page, timeout_ms):
+    """
+    Block until no stop button is visible, reacting to DOM changes in the page.
+
+    Returns True when streaming has stopped, False on timeout, or None if the
+    observer could not run (e.g. the page navigated mid-wait).
+    """
+    try:
+        return page.evaluate(_STOP_GONE_JS, [STOP_SELECTORS, STOP_TEXT, timeout_ms])
+    except Exception as e:
+        print(f"    [debug] Stop-button observer failed, polling instead: {e}")
+        return None
+
+
+def stop_visible(ui):
+    """True if any known stop-generation button is visible."""
+    for btn in ui.stop_buttons:
         try:
-            para_count = page.locator('p.font-claude-response-body').count()
-            if para_count == last_para_count and para_count > 0:
-                stable_count += 1
-                if stable_count >= 7:  # Stable for 14 seconds
-                    print(f"    [debug] Content stable at {para_count} paragraphs")
-                    break
-            else:
-                stable_count = 0
-                last_para_count = para_count
+            if btn.count() > 0 and btn.is_visible():
+                return True
         except:
-            pass
-        time.sleep(2)
+            continue
+    return False
 
-    # Final settle
-    time.sleep(3)
-    return True
 
+def wait_for_quiescence(ui, timeout_s=90, stable_checks=3, interval=0.5, max_interval=2.0):
+    """
+    Wait until the last assistant message stops changing.
 
-def get_response_text(page):
+    Samples the response length and returns as soon as it is unchanged for
+    `stable_checks` checks in a row with no stop button visible. While the
+    text is still changing the sampling interval doubles, up to `max_interval`.
+    """
+    deadline = time.monotonic() + timeout_s
+    delay = interval
+    last_len = -1
+    stable = 0
+    while time.monotonic() < deadline:
+        length = last_message_length(ui)
+        if length >= 0 and length == last_len and not stop_visible(ui):
+            stable += 1
+            if stable >= stable_checks:
+                return True
+            delay = interval
+        else:
+            stable = 0
+            last_len = length
+            delay = min(delay * 2, max_interval)
+        time.sleep(delay)
+    return False
+
+
+def get_response_text(ui):
     """Extract the full assistant response text from the page, excluding MCP tool call UI."""
     # Priority 1: Get prose paragraphs from the LAST assistant message only
     # This excludes MCP tool call UI (Request/Response JSON blocks)
     try:
         # Find all assistant message containers
-        assistant_msgs = page.locator('div[data-is-streaming]').all()
+        assistant_msgs = ui.assistant.all()
         if assistant_msgs:
             last_msg = assistant_msgs[-1]
             # Get only the prose paragraphs within the last message
@@ -192,7 +263,7 @@ def get_response_text(page):
 
     # Priority 2: Get all prose paragraphs (may include earlier messages)
     try:
-        paragraphs = page.locator('p.font-claude-response-body').all()
+        paragraphs = ui.paragraphs.all()
         if paragraphs:
             text = '\n\n'.join(p.inner_text() for p in paragraphs)
             if text and len(text) > 10:
@@ -202,7 +273,7 @@ def get_response_text(page):
 
     # Priority 3: Try font-claude-message but filter out tool UI text
     try:
-        messages = page.locator('div.font-claude-message').all()
+        messages = ui.response_container.all()
         if messages:
             last_msg = messages[-1]
             text = last_msg.inner_text()
@@ -229,35 +300,46 @@ def get_response_text(page):
 
     # Last resort: get main content
     try:
-        conv = page.locator('main').first
-        return conv.inner_text()
+        return ui.main.inner_text()
     except:
         return ""
 
 
-def send_query(page, query_text):
+def take_screenshot(ui, path, full_page=False):
+    """Screenshot the last Claude message, or the whole scrolled page with full_page=True."""
+    page = ui.page
+    if full_page:
+        page.evaluate("window.scrollTo(0, 0)")
+        time.sleep(1)
+        page.screenshot(path=str(path), full_page=True)
+        return
+    messages = ui.response_container
+    count = messages.count()
+    if count:
+        messages.nth(count - 1).screenshot(path=str(path))
+    else:
+        page.screenshot(path=str(path))  # Nothing rendered; keep the viewport for debugging
+
+
+def send_query(ui, query_text):
     """Type a query into the composer and send it."""
-    # Find the contenteditable composer
-    composer = page.locator('div[contenteditable="true"]').first
+    composer = ui.composer
     composer.click()
-    time.sleep(0.3)
-
-    # Clear and type
+    expect(composer).to_be_focused(timeout=5_000)
+    # Drop any restored draft, then insert the query as one input event
+    # instead of letting the ProseMirror editor process it keystroke by keystroke
     composer.fill("")
-    time.sleep(0.2)
-    composer.fill(query_text)
-    time.sleep(0.5)
+    ui.page.keyboard.insert_text(query_text)
 
-    # Send - try multiple selectors
-    send_selectors = [
-        'button[aria-label="Send Message"]',
-        'button[type="submit"]',
-        'button:has-text("Send")',
-    ]
+    # Wait until a send button is ready; if none shows up, Enter still works
+    try:
+        expect(ui.send_any).to_be_enabled(timeout=5_000)
+    except AssertionError:
+        pass
 
-    for selector in send_selectors:
+    # Send - try multiple selectors
+    for send in ui.send_buttons:
         try:
-            send = page.locator(selector).first
             if send.is_visible():
                 send.click()
                 return
@@ -269,9 +351,22 @@ def send_query(page, query_text):
 
 
 def start_new_chat(page):
-    """Navigate to a fresh chat."""
-    page.goto("https://claude.ai/new", wait_until="networkidle")
-    time.sleep(3)
+    """
+    Open a fresh chat.
+
+    Uses the app's own new-chat link when the app is already loaded, so the
+    SPA isn't reloaded for every query; falls back to a full page load.
+    """
+    if page.url.startswith("https://claude.ai"):
+        try:
+            page.locator(SELECTORS["new_chat"]).first.click(timeout=5_000)
+            page.wait_for_url(lambda url: url.rstrip("/").endswith("/new"), timeout=10_000)
+            # The previous conversation must be gone before we watch for a new response
+            page.locator(SELECTORS["assistant_msg"]).first.wait_for(state="detached", timeout=10_000)
+            return
+        except Exception as e:
+            print(f"    [debug] In-app new chat failed, reloading: {e}")
+    page.goto("https://claude.ai/new", wait_until="domcontentloaded")
 
 
 def run_queries(
@@ -282,32 +377,29 @@ def run_queries(
     only_queries=None,
     headless=False,
     take_screenshots=False,
+    full_page_screenshot=False,
     query_delay=60,
+    max_delay=600,
     max_retries=3,
+    session=None,
 ):
     """Read CSV, send each query, capture response text and server log."""
     RESPONSES_DIR.mkdir(exist_ok=True)
     if take_screenshots:
         SCREENSHOTS_DIR.mkdir(exist_ok=True)
 
-    queries = []
-    with open(csv_path, newline="", encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            queries.append(row)
-
-    if not queries:
+    total = count_queries(csv_path)
+    if not total:
         print("No queries found in CSV.")
         return
 
     tag = dataset_tag or Path(csv_path).stem
     # Detect mode from path
     mode = "multi" if "multiple" in csv_path else "single"
-    results = []
     # Filename: claude_{dataset}_{mode}_{timestamp}.json
     results_path = RESPONSES_DIR / f"claude_{tag}_{mode}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
 
-    print(f"Loaded {len(queries)} queries from {csv_path}")
+    print(f"Loaded {total} queries from {csv_path}")
     print(f"Starting from query #{start_from}")
     print(f"Responses -> {RESPONSES_DIR}/")
     if server_log:
@@ -316,32 +408,23 @@ def run_queries(
         print(f"Screenshots -> {SCREENSHOTS_DIR}/")
     print()
 
-    with sync_playwright() as p:
-        context = p.chromium.launch_persistent_context(
-            user_data_dir=str(AUTH_DIR),
-            headless=headless,
-            channel="chromium",
-            viewport={"width": 1440, "height": 900},
-            args=[
-                "--disable-blink-features=AutomationControlled",
-                "--no-sandbox",
-                "--disable-setuid-sandbox",
-            ],
-            ignore_default_args=["--enable-automation"],
-        )
-        page = context.pages[0] if context.pages else context.new_page()
-        page.set_default_timeout(60_000)
-
-        for qno, row in enumerate(queries, 1):
-            query_no = int(row.get("no", qno))
+    results_log = ResultsLog(results_path, tag, csv_path, total)
+    # Reuse the caller's browser (serve mode) or start one just for this CSV
+    session_cm = nullcontext(session) if session else TesterSession(
+        AUTH_DIR, PageHandles, headless, query_delay, max_delay)
+    with results_log, session_cm as session:
+        page = session.page
+        ui = session.ui
+        throttle = session.throttle
+        log_tail = LogTail(server_log)
+
+        for query_no, row in iter_queries(csv_path, start_from):
             query = row["query"]
 
-            if query_no < start_from:
-                continue
             if only_queries and query_no not in only_queries:
                 continue
 
-            print(f"[{query_no}/{len(queries)}] {query[:80]}...")
+            print(f"[{query_no}/{total}] {query[:80]}...")
 
             # Retry logic
             result_row = None
@@ -352,19 +435,19 @@ def run_queries(
                         print(f"    [RETRY {attempt}/{max_retries}] Retrying query...")
                         time.sleep(10)  # Extra wait before retry
 
-                    # Snapshot server log before query
-                    log_before = read_server_log(server_log)
+                    # Only telemetry logged from here on belongs to this query
+                    log_tail.mark()
 
                     start_new_chat(page)
 
                     # Send query
-                    send_query(page, query)
+                    send_query(ui, query)
 
                     # Wait for response
-                    success = wait_for_response(page, timeout_ms=180_000)
+                    success = wait_for_response(ui, timeout_ms=180_000)
 
                     # Capture response text
-                    response_text = get_response_text(page)
+                    response_text = get_response_text(ui)
 
                     # Check if we got a valid response
                     if not response_text or len(response_text.strip()) < 20:
@@ -372,22 +455,15 @@ def run_queries(
 
                     print(f"    Response: {response_text[:120]}...")
 
-                    # Snapshot server log after
-                    log_after = read_server_log(server_log)
-                    new_log = ""
-                    if log_after and log_before:
-                        new_log = log_after[len(log_before):] if log_after.startswith(log_before) else log_after
-                    elif log_after:
-                        new_log = log_after
+                    # Telemetry logged while this query ran
+                    new_log = log_tail.read_new()
 
                     # Optional screenshot
                     ss_name = ""
                     if take_screenshots:
-                        page.evaluate("window.scrollTo(0, 0)")
-                        time.sleep(1)
                         ss_name = f"{tag}_{query_no:02d}.png"
                         ss_path = SCREENSHOTS_DIR / ss_name
-                        page.screenshot(path=str(ss_path), full_page=True)
+                        take_screenshot(ui, ss_path, full_page=full_page_screenshot)
                         print(f"    Screenshot: {ss_path}")
 
                     status = "PASS" if success else "TIMEOUT"
@@ -425,28 +501,21 @@ def run_queries(
                         except:
                             pass
 
-            results.append(result_row)
-
             # Save after each query (outside try-except to always save progress)
-            with open(results_path, "w", encoding="utf-8") as f:
-                json.dump({
-                    "dataset": tag,
-                    "csv": str(csv_path),
-                    "timestamp": datetime.now().isoformat(),
-                    "total_queries": len(queries),
-                    "results": results,
-                }, f, indent=2, ensure_ascii=False)
-
-            # Rate limit delay
-            if query_no < len(queries):
-                print(f"    Waiting {query_delay}s before next query...")
-                time.sleep(query_delay)
+            results_log.append(result_row)
 
-        context.close()
+            # Rate limit delay: backs off while the service is throttling us
+            if limit_banner_visible(ui):
+                throttle.hit()
+            delay = throttle.next_delay()
+            if query_no < total:
+                print(f"    Waiting {delay:g}s before next query...")
+                time.sleep(delay)
 
     print(f"\nDone. Results -> {results_path}")
 
     # Print summary
+    results = results_log.results
     passed = sum(1 for r in results if r["status"] == "PASS")
     failed = sum(1 for r in results if r["status"] != "PASS")
     print(f"Summary: {passed} passed, {failed} failed/timeout out of {len(results)} run")
@@ -459,6 +528,9 @@ def main():
         help="Open browser to log in and save auth state.",
     )
     parser.add_argument("--csv", type=str, help="Path to queries CSV file")
+    parser.add_argument("--serve", action="store_true",
+                        help="Keep one browser open and run each CSV path read from stdin "
+                             "(one per line, optionally followed by a dataset tag)")
     parser.add_argument("--dataset", type=str, default=None,
                         help="Dataset tag for filenames (default: CSV stem)")
     parser.add_argument("--server-log", type=str, default="",
@@ -468,27 +540,42 @@ def main():
     parser.add_argument("--only", type=str, default=None,
                         help="Only run specific query numbers (comma-separated, e.g., '2,4,7,10')")
     parser.add_argument("--delay", type=int, default=60,
-                        help="Delay between queries in seconds (default: 60)")
+                        help="Minimum delay between queries in seconds (default: 60)")
+    parser.add_argument("--max-delay", type=int, default=600,
+                        help="Cap for the delay when backing off on rate limits (default: 600)")
     parser.add_argument("--retries", type=int, default=3,
                         help="Number of retries per query on failure (default: 3)")
     parser.add_argument("--headless", action="store_true",
                         help="Run in headless mode")
     parser.add_argument("--screenshots", action="store_true",
                         help="Take screenshots (off by default)")
+    parser.add_argument("--full-page-screenshot", action="store_true",
+                        help="Screenshot the whole page instead of just the last response")
     args = parser.parse_args()
 
     if args.save_auth:
         save_auth()
         return
 
-    if not args.csv:
-        parser.error("--csv is required when not using --save-auth")
+    if not args.csv and not args.serve:
+        parser.error("--csv is required when not using --save-auth or --serve")
 
     if not AUTH_DIR.exists():
         print(f"Auth not found at {AUTH_DIR}")
         print("Run: python tester_claude.py --save-auth")
         sys.exit(1)
 
+    if args.serve:
+        serve(
+            run_queries,
+            TesterSession(AUTH_DIR, PageHandles, args.headless, args.delay, args.max_delay),
+            server_log=args.server_log,
+            take_screenshots=args.screenshots,
+            full_page_screenshot=args.full_page_screenshot,
+            max_retries=args.retries,
+        )
+        return
+
     # Parse --only into a set of query numbers
     only_queries = None
     if args.only:
@@ -502,7 +589,9 @@ def main():
         only_queries=only_queries,
         headless=args.headless,
         take_screenshots=args.screenshots,
+        full_page_screenshot=args.full_page_screenshot,
         query_delay=args.delay,
+        max_delay=args.max_delay,
         max_retries=args.retries,
     )
 
@@ -0,0 +1,282 @@
+"""
+Shared plumbing for the Playwright MCP testers.
+
+Everything here is site-independent: telemetry log tailing, result files,
+query pacing, the persistent browser session, and CSV/stdin handling. Each
+tester keeps its own selectors, PageHandles, and query flow.
+"""
+
+import csv
+import hashlib
+import json
+import os
+import re
+import sys
+from datetime import datetime
+from pathlib import Path
+
+from playwright.sync_api import sync_playwright
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # Optional speedup; falls back to stdlib json
+
+# Usage / rate-limit notices the app shows outside the assistant message
+LIMIT_BANNER_RE = re.compile(
+    r"(usage|message|rate) limit|limit reached|out of (free )?messages|too many requests",
+    re.IGNORECASE,
+)
+
+# True if the element sits inside a chat message matching the given selector
+_IN_MESSAGE_JS = "(el, selector) => el.closest(selector) !== null"
+
+
+def _json_dump_pretty(obj, path):
+    """
+    Write obj as 2-space-indented, non-ASCII-preserving JSON.
+
+    orjson output matches the stdlib's except for float spelling (1e20 vs
+    1e+20) and NaN/Infinity (null); anything orjson can't encode, such as an
+    integer wider than 64 bits, is written with the stdlib instead.
+    """
+    if orjson:
+        try:
+            path.write_bytes(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+            return
+        except orjson.JSONEncodeError:
+            pass
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(obj, f, indent=2, ensure_ascii=False)
+
+
+class LogTail:
+    """Reads only what has been appended to the server telemetry log since the last mark."""
+
+    def __init__(self, log_path: str):
+        self.log_path = log_path
+        self.offset = 0
+
+    def mark(self):
+        """Skip everything logged so far (one stat, no read)."""
+        if not self.log_path:
+            return
+        try:
+            self.offset = os.path.getsize(self.log_path)
+        except OSError:
+            self.offset = 0
+
+    def read_new(self) -> str:
+        """Return the text appended since the last mark or read."""
+        if not self.log_path:
+            return ""
+        try:
+            with open(self.log_path, "rb") as f:
+                if os.fstat(f.fileno()).st_size < self.offset:
+                    self.offset = 0  # Log was truncated or rotated; take all of it
+                f.seek(self.offset)
+                data = f.read()
+                self.offset = f.tell()
+        except FileNotFoundError:
+            return ""
+        return data.decode("utf-8", errors="replace")
+
+
+class ResultsLog:
+    """
+    Appends each result to a .jsonl file as soon as it is ready, and writes the
+    aggregate JSON that parse_results.py reads once, on exit.
+
+    Saving a query costs one line instead of rewriting every earlier result.
+    The .jsonl opens with a line of run metadata and is only created once the
+    first result arrives; if the run is killed before the aggregate is written,
+    parse_results.py reads the .jsonl in its place.
+    """
+
+    def __init__(self, results_path, dataset, csv_path, total_queries):
+        self.results_path = results_path
+        self.jsonl_path = results_path.with_suffix(".jsonl")
+        self.dataset = dataset
+        self.csv_path = csv_path
+        self.total_queries = total_queries
+        self.results = []
+        self._f = None
+
+    def __enter__(self):
+        return self
+
+    def _meta(self):
+        return {
+            "dataset": self.dataset,
+            "csv": str(self.csv_path),
+            "timestamp": datetime.now().isoformat(),
+            "total_queries": self.total_queries,
+        }
+
+    def append(self, record):
+        # Identical responses (e.g. the same tool failure) share a hash, so repeats are easy to spot
+        record["response_hash"] = hashlib.sha256(record["response_text"].encode("utf-8")).hexdigest()
+        self.results.append(record)
+        if self._f is None:
+            self._f = open(self.jsonl_path, "w", encoding="utf-8", buffering=1)  # Line-buffered
+            self._f.write(json.dumps(self._meta(), ensure_ascii=False) + "\n")
+        self._f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def __exit__(self, *exc):
+        if self._f is None:
+            return False
+        self._f.close()
+        _json_dump_pretty({**self._meta(), "results": self.results}, self.results_path)
+        return False
+
+
+class Throttle:
+    """
+    Delay between queries that only backs off while the service is pushing back.
+
+    Starts at `min_delay`. A query that saw an HTTP 429 or a limit banner on the
+    page doubles the delay (up to `max_delay`); a clean query halves it again.
+    The model's own response is never inspected: a reply that mentions rate
+    limits is an answer, not the service pushing back.
+    """
+
+    def __init__(self, min_delay=60, max_delay=600):
+        self.min_delay = min_delay
+        self.max_delay = max(max_delay, min_delay)
+        self.delay = min_delay
+        self.limited = False
+
+    def hit(self):
+        """Note that the service pushed back during the current query."""
+        self.limited = True
+
+    def on_response(self, response):
+        """page.on("response") handler: note any 429 seen while a query runs."""
+        if response.status == 429:
+            self.hit()
+
+    def next_delay(self):
+        """Delay to wait before the next query, given how the last one went."""
+        if self.limited:
+            self.delay = min(self.delay * 2, self.max_delay)
+        else:
+            self.delay = max(self.delay / 2, self.min_delay)
+        self.limited = False
+        return self.delay
+
+
+class TesterSession:
+    """
+    One persistent Chromium context, kept open across any number of CSV runs.
+
+    run_queries opens a session per CSV by default; serve() opens one and
+    passes it to every run so the browser cold start is paid once. The
+    Throttle lives here too, since back-off applies to the service, not a CSV.
+    `page_handles` is the tester's PageHandles class, built once for the page.
+    """
+
+    def __init__(self, auth_dir, page_handles, headless=False, query_delay=60, max_delay=600):
+        self.auth_dir = auth_dir
+        self.page_handles = page_handles
+        self.headless = headless
+        self.throttle = Throttle(query_delay, max_delay)
+
+    def __enter__(self):
+        self._playwright = sync_playwright().start()
+        try:
+            self.context = self._playwright.chromium.launch_persistent_context(
+                user_data_dir=str(self.auth_dir),
+                headless=self.headless,
+                channel="chromium",
+                viewport={"width": 1440, "height": 900},
+                args=[
+                    "--disable-blink-features=AutomationControlled",
+                    "--no-sandbox",
+                    "--disable-setuid-sandbox",
+                ],
+                ignore_default_args=["--enable-automation"],
+            )
+        except Exception:
+            self._playwright.stop()
+            raise
+        self.page = self.context.pages[0] if self.context.pages else self.context.new_page()
+        self.page.set_default_timeout(60_000)
+        self.page.on("response", self.throttle.on_response)
+        self.ui = self.page_handles(self.page)
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            self.context.close()
+        finally:
+            self._playwright.stop()
+        return False
+
+
+def last_message_length(ui):
+    """Text length of the last assistant message, or -1 if it can't be read right now."""
+    try:
+        messages = ui.assistant
+        count = messages.count()
+        return len(messages.nth(count - 1).inner_text(timeout=2_000)) if count else 0
+    except Exception:
+        return -1  # Re-rendering; treat as still changing
+
+
+def limit_banner_visible(ui):
+    """
+    True if the page shows a usage or rate-limit notice outside the conversation.
+
+    Matches inside a chat message (`ui.message_selector`) are ignored, so a query
+    or reply that talks about rate limits never triggers a back-off.
+    """
+    try:
+        banners = ui.limit_banner
+        for i in range(banners.count()):
+            banner = banners.nth(i)
+            if banner.is_visible() and not banner.evaluate(_IN_MESSAGE_JS, ui.message_selector):
+                return True
+        return False
+    except Exception:
+        return False
+
+
+def count_queries(csv_path):
+    """Number of query rows in the CSV, counted in one streaming pass."""
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        return max(sum(1 for row in csv.reader(f) if row) - 1, 0)  # Minus the header
+
+
+def iter_queries(csv_path, start_from=1):
+    """Yield (query_no, row) for each CSV row numbered start_from or later, read lazily."""
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        for qno, row in enumerate(csv.DictReader(f), 1):
+            query_no = int(row.get("no", qno))
+            if query_no >= start_from:
+                yield query_no, row
+
+
+def serve(run_queries, session, **run_kwargs):
+    """
+    Keep one browser open and run every CSV named on stdin, one per line.
+
+    Each line is a CSV path, optionally followed by a dataset tag. `session` is
+    an unopened TesterSession shared by every run; other options (server log,
+    screenshots, ...) are passed to each run_queries call.
+    """
+    with session:
+        for line in sys.stdin:
+            parts = line.split()
+            if not parts:
+                continue
+            csv_path = parts[0]
+            dataset_tag = parts[1] if len(parts) > 1 else None
+            if not Path(csv_path).exists():
+                print(f"[warn] {csv_path} not found, skipping")
+                continue
+            print(f">>> {dataset_tag or Path(csv_path).stem} at {datetime.now().isoformat(timespec='seconds')}")
+            try:
+                run_queries(csv_path, dataset_tag, session=session, **run_kwargs)
+            except Exception as e:
+                print(f"[ERROR] Run for {csv_path} failed: {e}")
+            print()
@@ -0,0 +1,67 @@
+"""Tests for judge.py's NDJSON progress checkpoint (run: python -m unittest discover tests)."""
+
+import json
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import judge  # noqa: E402
+
+
+def _row(no):
+    return {"platform": "claude", "mode": "single", "dataset": "CPI", "no": str(no), "score_filter_accuracy": "1"}
+
+
+class LoadNdjsonTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = Path(tmp.name) / "judge_results.ndjson"
+
+    def write(self, text):
+        self.path.write_text(text, encoding="utf-8")
+
+    def append_rows(self, rows):
+        with open(self.path, "a", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+    def test_resume_after_torn_line_keeps_appended_rows(self):
+        good = [_row(i) for i in range(1, 41)]
+        self.write("".join(json.dumps(r) + "\n" for r in good) + '{"platform": "claude", "mo')
+
+        self.assertEqual(judge.load_ndjson(self.path, repair=True), good)
+        new = [_row(i) for i in range(41, 99)]
+        self.append_rows(new)
+
+        self.assertEqual(judge.load_ndjson(self.path), good + new)
+
+    def test_rows_after_a_torn_line_are_still_read(self):
+        # A file damaged before repair existed: the torn line sits mid-file
+        self.write(json.dumps(_row(1)) + "\n" + '{"no": "2", "da' + json.dumps(_row(3)) + "\n")
+        self.append_rows([_row(4)])
+
+        self.assertEqual(judge.load_ndjson(self.path), [_row(1), _row(4)])
+
+    def test_repair_restores_missing_final_newline(self):
+        self.write(json.dumps(_row(1)) + "\n" + json.dumps(_row(2)))
+
+        self.assertEqual(judge.load_ndjson(self.path, repair=True), [_row(1), _row(2)])
+        self.append_rows([_row(3)])
+
+        self.assertEqual(judge.load_ndjson(self.path), [_row(1), _row(2), _row(3)])
+
+    def test_repair_drops_torn_multibyte_character(self):
+        full = json.dumps(_row(2) | {"filter_notes": "₹ crore"}, ensure_ascii=False).encode("utf-8")
+        cut = full[:full.index("₹".encode("utf-8")) + 1]
+        self.path.write_bytes(json.dumps(_row(1)).encode("utf-8") + b"\n" + cut)
+
+        self.assertEqual(judge.load_ndjson(self.path, repair=True), [_row(1)])
+        self.assertEqual(self.path.read_bytes(), json.dumps(_row(1)).encode("utf-8") + b"\n")
+
+
+if __name__ == "__main__":
+    unittest.main()